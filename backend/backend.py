@@ -5,17 +5,29 @@
 import re
 import sys
 import json
+import functools
+import threading
 import traceback
-from time import sleep
+from time import monotonic, sleep
 from datetime import datetime, timedelta, timezone
-from dataclasses import dataclass
-from typing import Any, Dict, Optional, Tuple, List, Literal, Union, TypedDict, cast
-
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple, List, Literal, Set, Union
+from typing import TypedDict, cast
+
+import metrics
+import tracing
+from tracing import PROFILE_RPC_THRESHOLD, PROFILE_TICK_THRESHOLD
 from target import Target, TargetName
 from repository_config import REPOSITORY_CONFIGS, get_repository_config_by_name
-from kubernetes_util import KubernetesUtil
+from kubernetes_util import KubernetesUtil, RunUploadUrls
+from storage_util import StorageUtil
+from dashboard_manifest import DashboardManifest, DashboardEntry, Manifest
+from job_index import JobIndex, job_is_active
+from work_queue import KeyedWorkQueue
 from github_util import (
     GithubUtil,
+    set_http_pool_size,
     CommitSha,
     Commit,
     Comment,
@@ -25,25 +37,33 @@ from github_util import (
     CheckRunExternalId,
     PullRequestNumber,
     GithubEvent,
+    response_cache,
+    target_configs,
 )
 
-from kubernetes.client.models.v1_job_list import V1JobList
 from kubernetes.client.models.v1_job import V1Job
 
 import google.auth
 import google.cloud.pubsub  # type: ignore
 import google.cloud.storage  # type: ignore
 
-
-gcp_project: str = google.auth.default()[1] or ""
-storage_client = google.cloud.storage.Client(project=gcp_project)
-subscriber_client = google.cloud.pubsub.SubscriberClient()
-output_bucket = storage_client.get_bucket("cp2k-ci")
-
-kubeutil = KubernetesUtil(
-    output_bucket=output_bucket,
-    image_base=f"us-central1-docker.pkg.dev/{gcp_project}/cp2kci",
+# The clients get created by init_services(), which is called by main().
+gcp_project = ""
+storage_client: Any = None
+output_bucket: Any = None
+storage: StorageUtil
+dashboard_manifest: DashboardManifest
+kubeutil: KubernetesUtil
+job_index: JobIndex
+
+RPC_WORKERS = 8
+SUBMISSION_WORKERS = 8
+rpc_queue = KeyedWorkQueue(max_workers=RPC_WORKERS)
+submission_executor = ThreadPoolExecutor(
+    max_workers=SUBMISSION_WORKERS, thread_name_prefix="submit"
 )
+# Besides the workers, also the main loop and the token refresh talk to GitHub.
+set_http_pool_size(RPC_WORKERS + SUBMISSION_WORKERS + 2)
 
 
 # TODO Share with frontend.py and cp2kcictl.py
@@ -95,6 +115,10 @@ class ProcessPullRequestRequest(TypedDict):
     pr_number: PullRequestNumber
 
 
+class RebuildDashboardManifestRequest(TypedDict):
+    rpc: Literal["rebuild_dashboard_manifest"]
+
+
 class GithubEventRequest(TypedDict):
     rpc: Literal["github_event"]
     event: str
@@ -108,6 +132,7 @@ RpcRequest = Union[
     SubmitTaggedDashboardTestsRequest,
     SubmitDashboardTestRequest,
     SubmitDashboardTestForceRequest,
+    RebuildDashboardManifestRequest,
     SubmitCheckRunRequest,
     SubmitCheckRunNocacheRequest,
     ProcessPullRequestRequest,
@@ -115,26 +140,111 @@ RpcRequest = Union[
 ]
 
 
+# ======================================================================================
+MergeabilityCallback = Callable[[Optional[CommitSha]], None]
+
+# Give GitHub this much time to compute the mergeability of a pull request.
+MERGEABILITY_TIMEOUT = timedelta(seconds=50)
+
+
+@dataclass
+class PendingMergeabilityCheck:
+    head_sha: CommitSha  # The newest head, whose deadline applies.
+    deadline: datetime
+    check_runs: List[CheckRun] = field(default_factory=list)  # "Waiting for ..."
+    # Callbacks of events, which came in while waiting, along with their head sha.
+    callbacks: List[Tuple[CommitSha, MergeabilityCallback]] = field(
+        default_factory=list
+    )
+
+
+pending_mergeability_checks: Dict[
+    Tuple[str, PullRequestNumber], PendingMergeabilityCheck
+] = {}
+pending_mergeability_checks_lock = threading.Lock()
+
+
+# ======================================================================================
+DashboardDecision = Literal["submit", "defer", "skip"]
+
+
+@dataclass
+class DeferredDashboardTest:
+    target: Target  # Waits for its target.cache_from to get published.
+    head_sha: str
+
+
+deferred_dashboard_tests: Dict[TargetName, DeferredDashboardTest] = {}
+deferred_dashboard_tests_lock = threading.Lock()
+
+
 # ======================================================================================
 @dataclass
 class Report:
     summary: str
     status: str
     git_sha: Optional[str]
+    bytes_read: int = 0
+
+
+# The runners append a trailer with these fields, followed by the EndDate line.
+REPORT_TRAILER_FIELDS = ("CP2K-CI-Summary", "CP2K-CI-Status", "CP2K-CI-CommitSHA")
+REPORT_TAIL_SIZE = 8 * 1024
+
+
+# ======================================================================================
+def init_services(
+    project: Optional[str] = None,
+    client: Any = None,
+    batch_api: Any = None,
+    watch_factory: Optional[Callable[[], Any]] = None,
+    signing_credentials: Any = None,
+) -> None:
+    # The optional arguments allow to inject fakes, e.g. for benchmark.py.
+    global gcp_project, storage_client, output_bucket, storage, dashboard_manifest
+    global kubeutil, job_index
+    gcp_project = project or google.auth.default()[1] or ""
+    if client is None:
+        client = google.cloud.storage.Client(project=gcp_project)
+        client._http.hooks["response"].append(metrics.observe_gcs_response)
+    storage_client = client
+    output_bucket = storage_client.get_bucket("cp2k-ci")
+    storage = StorageUtil(storage_client, output_bucket)
+    dashboard_manifest = DashboardManifest(output_bucket)
+
+    kubeutil = KubernetesUtil(
+        output_bucket=output_bucket,
+        storage=storage,
+        image_base=f"us-central1-docker.pkg.dev/{gcp_project}/cp2kci",
+        batch_api=batch_api,
+        watch_factory=watch_factory,
+        signing_credentials=signing_credentials,
+    )
+    job_index = JobIndex(kubeutil, "cp2kci=run")
 
 
 # ======================================================================================
 def main() -> None:
     print("starting")
+    init_services()
+    metrics.start_metrics_server()
+
+    # watch jobs
+    job_index.start()
 
     # subscribe to pubsub
+    subscriber_client = google.cloud.pubsub.SubscriberClient()
     sub_name = "projects/" + gcp_project + "/subscriptions/cp2kci-subscription"
     subscriber_client.subscribe(sub_name, process_pubsub_message)
 
     print("starting main loop")
     for i in range(sys.maxsize):
         try:
-            tick(i)
+            with metrics.tick_duration.time(), tracing.correlated(f"tick/{i}"):
+                with tracing.span("tick"):
+                    with tracing.profiled("tick", PROFILE_TICK_THRESHOLD):
+                        tick(i)
+            metrics.record_tick_completed()
         except:
             print(traceback.format_exc())
         sleep(5)
@@ -142,29 +252,133 @@ def main() -> None:
 
 # ======================================================================================
 def tick(cycle: int) -> None:
-    run_job_list = kubeutil.list_jobs("cp2kci=run")
+    resume_mergeability_checks()
     if cycle % 30 == 0:  # every 2.5 minutes
-        poll_pull_requests(run_job_list)
-    for job in run_job_list.items:
-        record_job_start_time(job)
-        job_annotations = job.metadata.annotations
-        if "cp2kci-dashboard" in job_annotations:
-            publish_job_to_dashboard(job)
-        if "cp2kci-check-run-url" in job_annotations:
-            publish_job_to_github(job)
-        if job.status.completion_time and "cp2kci-force" not in job_annotations:
-            kubeutil.delete_job(job.metadata.name)  # keep failed jobs for investigation
+        poll_pull_requests()
+        job_index.mark_changed()  # revisit all jobs as a safeguard
+        print(f"Github response cache: {response_cache.stats()}")
+        print(f"Target config cache: {target_configs.stats()}")
+        print(f"Blob state cache: {storage.states.stats()}")
+    for state, count in job_index.count_jobs().items():
+        metrics.jobs.labels(state).set(count)
+    try:
+        waiting_jobs = job_index.list_jobs(state="waiting")
+        storage.refresh([report_path(job) for job in waiting_jobs])
+        for job in waiting_jobs:
+            record_job_start_time(job)
+        changed_jobs = job_index.pop_changed_jobs()
+        prefetch_blob_states([j for j in changed_jobs if not job_is_active(j)])
+        for job in changed_jobs:
+            try:
+                process_job(job)
+            except:
+                print(traceback.format_exc())
+                job_index.mark_changed(job.metadata.name)  # retry in next tick
+    finally:
+        storage.flush()  # send the queued metadata patches
+
+
+# ======================================================================================
+def report_path(job: V1Job) -> str:
+    return str(job.metadata.annotations["cp2kci-report-path"])
+
+
+# ======================================================================================
+def prefetch_blob_states(finished_jobs: List[V1Job]) -> None:
+    # Load the blobs of finished jobs in one go, otherwise they're looked up one by one.
+    paths = [report_path(job) for job in finished_jobs]
+    paths += [
+        job.metadata.annotations["cp2kci-artifacts-path"] for job in finished_jobs
+    ]
+    try:
+        storage.refresh(paths)
+    except:
+        print(traceback.format_exc())
+
+
+# ======================================================================================
+def process_job(job: V1Job) -> None:
+    record_job_start_time(job)
+    job_annotations = job.metadata.annotations
+    if "cp2kci-dashboard" in job_annotations:
+        publish_job_to_dashboard(job)
+    if "cp2kci-check-run-url" in job_annotations:
+        publish_job_to_github(job)
+    if job.status.completion_time and "cp2kci-force" not in job_annotations:
+        job_index.delete_job(job.metadata.name)  # keep failed jobs for investigation
 
 
 # ======================================================================================
 def process_pubsub_message(message: Any) -> None:
     try:
-        rpc = json.loads(message.data)
-        process_rpc(rpc)
-        message.ack()  # ack late in case we get preempted in the middle
+        rpc: RpcRequest = json.loads(message.data)
     except:
         print(traceback.format_exc())
         message.ack()  # prevent crash looping
+        return
+
+    try:
+        key, coalesce_tag = rpc_lane(rpc)
+    except:
+        key, coalesce_tag = None, None  # process_rpc() will run into the same problem
+
+    rpc_name = rpc.get("rpc", "unknown")
+    received = monotonic()
+    metrics.pubsub_messages_in_flight.inc()
+
+    def task() -> None:
+        with tracing.span("rpc", rpc=rpc_name):
+            with tracing.profiled(f"rpc {rpc_name}", PROFILE_RPC_THRESHOLD):
+                process_rpc(rpc)
+
+    def on_done() -> None:
+        message.ack()  # ack late in case we get preempted in the middle
+        metrics.pubsub_messages_in_flight.dec()
+        latency = monotonic() - received
+        metrics.rpc_latency.labels(rpc_name).observe(latency)
+
+    # RPCs for the same PR are processed one after another, others in parallel.
+    # Errors get printed by the queue and the message is acked regardless.
+    # The correlation id is carried along by the queue and the executors.
+    prefix = f"{key[0]}#{key[1]}" if key else rpc_name
+    with tracing.correlated(tracing.new_correlation_id(prefix)):
+        rpc_queue.submit(key, task, coalesce_tag=coalesce_tag, on_done=on_done)
+
+
+# ======================================================================================
+def rpc_lane(
+    request: RpcRequest,
+) -> Tuple[Optional[Tuple[str, PullRequestNumber]], Optional[str]]:
+    # Returns the work queue key and coalesce tag for given RPC.
+    # Queued runs of process_pull_request are redundant because it loads the PR anew.
+    if request["rpc"] == "process_pull_request":
+        key = (request["repo"], request["pr_number"])
+        return key, "process_pull_request"
+
+    elif request["rpc"] in ("submit_check_run", "submit_check_run_nocache"):
+        return (request["repo"], request["pr_number"]), None
+
+    elif request["rpc"] == "github_event":
+        event, body = request["event"], request["body"]
+        repo = body["repository"]["name"]
+        action = body.get("action", "")
+        if event == "pull_request":
+            key = (repo, body["pull_request"]["number"])
+            if action in ("opened", "reopened", "synchronize"):
+                return key, "process_pull_request"
+            return key, None
+        elif event == "check_suite" and body["check_suite"].get("pull_requests"):
+            key = (repo, body["check_suite"]["pull_requests"][0]["number"])
+            if action == "rerequested":
+                return key, "process_pull_request"
+            return key, None
+        elif event == "check_run":
+            pr_number, _ = parse_external_id(body["check_run"]["external_id"])
+            return (repo, pr_number), None
+        elif event == "issue_comment":
+            return (repo, PullRequestNumber(body["issue"]["number"])), None
+
+    return None, None
 
 
 # ======================================================================================
@@ -184,15 +398,13 @@ def process_rpc(request: RpcRequest) -> None:
     elif request["rpc"] == "submit_all_dashboard_tests":
         gh = GithubUtil("cp2k")
         head_sha = gh.get_head_sha("master")
-        for target in gh.get_targets():
-            submit_dashboard_test(target, head_sha)
+        submit_dashboard_tests(gh.get_targets(), head_sha)
 
     elif request["rpc"] == "submit_tagged_dashboard_tests":
         gh = GithubUtil("cp2k")
         head_sha = gh.get_head_sha("master")
-        for target in gh.get_targets():
-            if request["tag"] in target.tags:
-                submit_dashboard_test(target, head_sha)
+        targets = [t for t in gh.get_targets() if request["tag"] in t.tags]
+        submit_dashboard_tests(targets, head_sha)
 
     elif request["rpc"] == "submit_dashboard_test":
         gh = GithubUtil("cp2k")
@@ -204,6 +416,9 @@ def process_rpc(request: RpcRequest) -> None:
         target = gh.get_target_by_name(request["target"])
         submit_dashboard_test(target, gh.get_head_sha("master"), force=True)
 
+    elif request["rpc"] == "rebuild_dashboard_manifest":
+        rebuild_dashboard_manifest()
+
     elif request["rpc"] == "submit_check_run":
         gh = GithubUtil(request["repo"])
         pr = gh.get_pull_request(request["pr_number"])
@@ -321,49 +536,118 @@ def process_issue_comment(
 
 
 # ======================================================================================
-def await_mergeability(
+def check_mergeability(
+    gh: GithubUtil, pr: PullRequest
+) -> Tuple[bool, Optional[CommitSha]]:
+    # https://developer.github.com/v3/git/#checking-mergeability-of-pull-requests
+    # Returns whether GitHub has decided yet, and if so, the merge commit's sha.
+    if pr.get("mergeable") == False:
+        return True, None  # not mergeable
+    elif pr.get("mergeable") == True:
+        # Check freshness of merge branch.
+        merge_commit = gh.get_head_commit(f"pull/{pr['number']}/merge")
+        if any(p["sha"] == pr["head"]["sha"] for p in merge_commit["parents"]):
+            return True, merge_commit["sha"]  # mergeable
+
+    # pr["mergeable"] is None or merge_commit is outdated.
+    return False, None
+
+
+# ======================================================================================
+def when_mergeable(
     gh: GithubUtil,
     pr: PullRequest,
     check_run_name: str,
     check_run_external_id: CheckRunExternalId,
-) -> Optional[CommitSha]:
-    # https://developer.github.com/v3/git/#checking-mergeability-of-pull-requests
+    callback: MergeabilityCallback,
+) -> None:
+    # Calls back with the merge sha, or None if the PR is not mergeable.
+    # Instead of blocking the caller, undecided PRs are re-checked by tick().
+    key = (gh.repo_conf.name, pr["number"])
+    with pending_mergeability_checks_lock:
+        pending = pending_mergeability_checks.get(key)
+    if not pending:
+        decided, merge_sha = check_mergeability(gh, pr)
+        if decided:
+            callback(merge_sha)
+            return
+
+    # This might take a while, tell the user and disable resubmit buttons.
+    check_run: CheckRun = {
+        "name": check_run_name,
+        "external_id": check_run_external_id,
+        "head_sha": pr["head"]["sha"],
+        "started_at": gh.now(),
+        "output": {"title": "Waiting for mergeability check", "summary": ""},
+    }
+    gh.post_check_run(check_run)
 
-    check_run: CheckRun
-
-    for i in range(10):
-        if pr.get("mergeable") == False:
-            return None  # not mergeable
-        elif pr.get("mergeable") == True:
-            # Check freshness of merge branch.
-            merge_commit = gh.get_head_commit(f"pull/{pr['number']}/merge")
-            if any(p["sha"] == pr["head"]["sha"] for p in merge_commit["parents"]):
-                return merge_commit["sha"]  # mergeable
-
-        # pr["mergeable"] is None or merge_commit is outdated.
-        # This might take a while, tell the user and disable resubmit buttons.
-        if i == 0:
-            check_run = {
-                "name": check_run_name,
-                "external_id": check_run_external_id,
-                "head_sha": pr["head"]["sha"],
-                "started_at": gh.now(),
-                "output": {"title": "Waiting for mergeability check", "summary": ""},
-            }
-            gh.post_check_run(check_run)
+    print(f"Waiting for mergeability check of PR {pr['number']}")
+    with pending_mergeability_checks_lock:
+        head_sha = pr["head"]["sha"]
+        deadline = datetime.now(timezone.utc) + MERGEABILITY_TIMEOUT
+        pending = pending_mergeability_checks.setdefault(
+            key, PendingMergeabilityCheck(head_sha, deadline)
+        )
+        if pending.head_sha != head_sha:
+            # A new push restarts GitHub's computation, hence also our timeout.
+            pending.head_sha, pending.deadline = head_sha, deadline
+        pending.check_runs.append(check_run)
+        # Resume within the current correlation id, although called back by tick().
+        pending.callbacks.append((head_sha, tracing.propagate(callback)))
 
-        # Reload pull request.
-        pr_number = pr["number"]
-        print(f"Waiting for mergeability check of PR {pr_number}")
-        sleep(5)
-        pr = gh.get_pull_request(pr_number)
 
-    # timeout
+# ======================================================================================
+def resume_mergeability_checks() -> None:
+    with pending_mergeability_checks_lock:
+        deadlines = {k: v.deadline for k, v in pending_mergeability_checks.items()}
+
+    for key, deadline in deadlines.items():
+        try:
+            repo, pr_number = key
+            gh = GithubUtil(repo)
+            pr = gh.get_pull_request(pr_number)
+            decided, merge_sha = check_mergeability(gh, pr)
+            timeout = datetime.now(timezone.utc) > deadline
+            if not decided and not timeout:
+                continue  # Still waiting.
+            with pending_mergeability_checks_lock:
+                pending = pending_mergeability_checks.pop(key)
+
+            # Events of replaced heads are superseded by the event of the newer push.
+            head_sha = pr["head"]["sha"]
+            for check_run in pending.check_runs:
+                if check_run["head_sha"] != head_sha:
+                    title = "Superseded by a newer commit."
+                    complete_waiting_check_run(gh, check_run, "skipped", title)
+            check_runs = [c for c in pending.check_runs if c["head_sha"] == head_sha]
+            callbacks = [c for sha, c in pending.callbacks if sha == head_sha]
+            num_dropped = len(pending.callbacks) - len(callbacks)
+            if num_dropped:
+                print(f"Dropped {num_dropped} outdated callbacks of PR {pr_number}.")
+
+            if decided:
+                # Resume in the PR's lane of the work queue.
+                for callback in callbacks:
+                    task = functools.partial(callback, merge_sha)
+                    rpc_queue.submit(key, task)
+            else:
+                print(f"Mergeability check timeout on PR {pr_number}")
+                for check_run in check_runs:
+                    title = "Mergeability check timeout."
+                    complete_waiting_check_run(gh, check_run, "failure", title)
+        except:
+            print(traceback.format_exc())
+
+
+# ======================================================================================
+def complete_waiting_check_run(
+    gh: GithubUtil, check_run: CheckRun, conclusion: str, title: str
+) -> None:
     check_run["completed_at"] = gh.now()
-    check_run["conclusion"] = "failure"
-    check_run["output"] = {"title": "Mergeability check timeout.", "summary": ""}
+    check_run["conclusion"] = conclusion
+    check_run["output"] = {"title": title, "summary": ""}
     gh.post_check_run(check_run)
-    raise Exception(f"Mergeability check timeout on PR {pr_number}")
 
 
 # ======================================================================================
@@ -377,7 +661,7 @@ def process_pull_request(
         print("Ignoring PR for non-master branch: " + pr["base"]["ref"])
         return
 
-    commits = list(gh.iterate_commits(pr["commits_url"]))
+    commits = list(gh.iterate_commits(pr["commits_url"] + "?per_page=100"))
 
     # Find previous check run conclusions, before we call cancel on them.
     prev_check_runs: List[CheckRun] = []
@@ -396,32 +680,91 @@ def process_pull_request(
     # Cancel old jobs. Conclusion "skipped" gets ignored when looking at previous runs.
     cancel_check_runs(target_pattern="*", gh=gh, pr=pr, sender=sender, set_skipped=True)
 
-    # check for merge commits
-    if not check_git_history(gh, pr, commits):
-        print("Git history test failed - not processing PR further.")
-        return
+    # Wait for mergeability check, then continue with the git history and check runs.
+    def resume(merge_sha: Optional[CommitSha]) -> None:
+        # check for merge commits
+        if not check_git_history(gh, pr, commits, merge_sha):
+            print("Git history test failed - not processing PR further.")
+            return
+
+        # submit check runs
+        targets = gh.get_targets(pr)
+        modified_files = []
+        if any(target.trigger_path for target in targets):
+            modified_files = [f["filename"] for f in gh.iterate_pr_files(pr)]
+        old_jobs = list_check_run_jobs("*", pr)
+
+        def submit(target: Target) -> None:
+            if target.name in prev_conclusions:
+                optional = prev_conclusions[target.name] in ("neutral", "cancelled")
+            else:
+                triggered = should_trigger(target, modified_files)
+                optional = not (target.is_required_check or triggered)
+            submit_check_run(
+                target,
+                gh,
+                pr,
+                sender,
+                optional=optional,
+                merge_sha=merge_sha,
+                old_jobs=[j for j in old_jobs if job_target(j) == target.name],
+            )
+
+        # Submit in parallel, a failing target should not hold up the others.
+        futures = [
+            submission_executor.submit(tracing.propagate(submit), target)
+            for target in targets
+        ]
+        num_failed = 0
+        for target, future in zip(targets, futures):
+            try:
+                future.result()
+            except:
+                print(traceback.format_exc())
+                report_submission_failure(target, gh, pr)
+                num_failed += 1
+        num_ok = len(targets) - num_failed
+        print(f"Submitted {num_ok} of {len(targets)} check runs for PR {pr_number}.")
 
-    # submit check runs
-    for target in gh.get_targets(pr):
-        if target.name in prev_conclusions:
-            optional = prev_conclusions[target.name] in ("neutral", "cancelled")
-        else:
-            optional = not (target.is_required_check or should_trigger(target, gh, pr))
-        submit_check_run(target, gh, pr, sender, optional=optional)
+    ext_id = format_external_id(pr["number"], "git-history")
+    when_mergeable(gh, pr, "Git History", ext_id, resume)
 
 
 # ======================================================================================
-def should_trigger(target: Target, gh: GithubUtil, pr: PullRequest) -> bool:
+def should_trigger(target: Target, modified_files: List[str]) -> bool:
     if target.trigger_path:
         trigger_path_re = re.compile(target.trigger_path)
-        for modified_file in gh.iterate_pr_files(pr):
-            if trigger_path_re.search(modified_file["filename"]):
+        for modified_file in modified_files:
+            if trigger_path_re.search(modified_file):
                 return True
     return False
 
 
 # ======================================================================================
-def check_git_history(gh: GithubUtil, pr: PullRequest, commits: List[Commit]) -> bool:
+def report_submission_failure(target: Target, gh: GithubUtil, pr: PullRequest) -> None:
+    try:
+        check_run: CheckRun = {
+            "name": target.display_name,
+            "external_id": format_external_id(pr["number"], target.name),
+            "head_sha": pr["head"]["sha"],
+            "started_at": gh.now(),
+            "completed_at": gh.now(),
+            "conclusion": "failure",
+            "output": {"title": "Submission of test run failed.", "summary": ""},
+            "actions": build_restart_actions(),
+        }
+        gh.post_check_run(check_run)
+    except:
+        print(traceback.format_exc())
+
+
+# ======================================================================================
+def check_git_history(
+    gh: GithubUtil,
+    pr: PullRequest,
+    commits: List[Commit],
+    merge_sha: Optional[CommitSha],
+) -> bool:
     check_run: CheckRun = {
         "name": "Git History",
         "external_id": format_external_id(pr["number"], "git-history"),
@@ -430,8 +773,6 @@ def check_git_history(gh: GithubUtil, pr: PullRequest, commits: List[Commit]) ->
         "completed_at": gh.now(),
     }
 
-    merge_sha = await_mergeability(gh, pr, check_run["name"], check_run["external_id"])
-
     if not merge_sha:
         check_run["conclusion"] = "failure"
         check_run["output"] = {"title": "Branch not mergeable.", "summary": ""}
@@ -474,6 +815,8 @@ def submit_check_run(
     sender: str,
     use_cache: bool = True,
     optional: bool = False,
+    merge_sha: Optional[CommitSha] = None,
+    old_jobs: Optional[List[V1Job]] = None,
 ) -> None:
     check_run: CheckRun = {
         "name": target.display_name,
@@ -500,14 +843,39 @@ def submit_check_run(
         gh.post_check_run(check_run)
         return
 
+    if merge_sha:
+        start_check_run(
+            check_run, target, gh, pr, sender, use_cache, merge_sha, old_jobs
+        )
+        return
+
     # Wait for mergeability check.
-    merge_sha = await_mergeability(gh, pr, check_run["name"], check_run["external_id"])
-    assert merge_sha
+    def resume(merge_sha: Optional[CommitSha]) -> None:
+        if not merge_sha:
+            print(f"Not submitting {target.name} for unmergeable PR {pr['number']}.")
+            return
+        start_check_run(check_run, target, gh, pr, sender, use_cache, merge_sha, None)
+
+    when_mergeable(gh, pr, check_run["name"], check_run["external_id"], resume)
+
 
+# ======================================================================================
+def start_check_run(
+    check_run: CheckRun,
+    target: Target,
+    gh: GithubUtil,
+    pr: PullRequest,
+    sender: str,
+    use_cache: bool,
+    merge_sha: CommitSha,
+    old_jobs: Optional[List[V1Job]],
+) -> None:
     # Delete old jobs - in case there are any.
-    for job in list_check_run_jobs(target.name, pr):
+    if old_jobs is None:
+        old_jobs = list_check_run_jobs(target.name, pr)
+    for job in old_jobs:
         print(f"Deleting old job {job.metadata.name}.")
-        kubeutil.delete_job(job.metadata.name)
+        job_index.delete_job(job.metadata.name)
 
     # Let's submit the new job.
     check_run = gh.post_check_run(check_run)
@@ -519,7 +887,7 @@ def submit_check_run(
         "cp2kci-check-run-html-url": check_run["html_url"],
         "cp2kci-check-run-status": "queued",
     }
-    kubeutil.submit_run(
+    new_job = kubeutil.submit_run(
         target,
         git_branch=f"pull/{pr['number']}/merge",
         git_ref=merge_sha,
@@ -527,6 +895,12 @@ def submit_check_run(
         use_cache=use_cache,
         # priority="high-priority",
     )
+    job_index.add(new_job)
+
+
+# ======================================================================================
+def job_target(job: V1Job) -> TargetName:
+    return TargetName(job.metadata.annotations["cp2kci-target"])
 
 
 # ======================================================================================
@@ -535,12 +909,8 @@ def list_check_run_jobs(
 ) -> List[V1Job]:
 
     results = []
-    for job in kubeutil.list_jobs("cp2kci=run").items:
+    for job in job_index.list_pr_jobs(pr["number"]):
         job_annotations = job.metadata.annotations
-        if "cp2kci-pull-request-number" not in job_annotations:
-            continue
-        if int(job_annotations["cp2kci-pull-request-number"]) != pr["number"]:
-            continue
         if job_annotations["cp2kci-check-run-status"] == "completed":
             continue
         if target_pattern not in ("*", job_annotations["cp2kci-target"]):
@@ -572,99 +942,237 @@ def cancel_check_runs(
             "actions": build_restart_actions(),
         }
         gh.patch_check_run(check_run)
-        kubeutil.delete_job(job.metadata.name)
+        job_index.delete_job(job.metadata.name)
+
+
+# ======================================================================================
+def submit_dashboard_tests(targets: List[Target], head_sha: str) -> None:
+    manifest, _ = dashboard_manifest.read()
+    eligible: List[Target] = []
+    scheduled: Set[TargetName] = set()  # submitted or deferred for head_sha
+    for target in order_by_cache_from(targets):
+        decision = decide_dashboard_test(target, head_sha, manifest, scheduled)
+        if decision == "submit":
+            eligible.append(target)
+            scheduled.add(target.name)
+        elif decision == "defer":
+            deferred = DeferredDashboardTest(target=target, head_sha=head_sha)
+            with deferred_dashboard_tests_lock:
+                deferred_dashboard_tests[target.name] = deferred
+            scheduled.add(target.name)
+    if not eligible:
+        return
+
+    # Sign all upload urls in one go instead of once per submission.
+    job_names = {t.name: kubeutil.new_job_name(t) for t in eligible}
+    upload_urls = kubeutil.sign_run_upload_urls(list(job_names.values()))
+    for target in eligible:
+        job_name = job_names[target.name]
+        start_dashboard_test(target, head_sha, False, job_name, upload_urls[job_name])
 
 
 # ======================================================================================
 def submit_dashboard_test(target: Target, head_sha: str, force: bool = False) -> None:
+    if force:
+        start_dashboard_test(target, head_sha, force=True)
+    else:
+        submit_dashboard_tests([target], head_sha)
+
+
+# ======================================================================================
+def order_by_cache_from(targets: List[Target]) -> List[Target]:
+    # Topological order, i.e. every target comes after the target it caches from.
+    targets_by_name = {t.name: t for t in targets}
+    ordered: List[Target] = []
+    visited: Set[TargetName] = set()
+
+    def visit(target: Target) -> None:
+        if target.name in visited:
+            return
+        visited.add(target.name)
+        if target.cache_from in targets_by_name:
+            visit(targets_by_name[target.cache_from])
+        ordered.append(target)
+
+    for target in targets:
+        visit(target)
+    return ordered
+
+
+# ======================================================================================
+def decide_dashboard_test(
+    target: Target, head_sha: str, manifest: Manifest, scheduled: Set[TargetName]
+) -> DashboardDecision:
     assert target.repository == "cp2k"
 
-    if not force:
-        # Check if a dashboard job for given target is already underway.
-        run_job_list = kubeutil.list_jobs("cp2kci=run")
-        for job in run_job_list.items:
-            if (
-                job.metadata.annotations["cp2kci-target"] == target.name
-                and "cp2kci-dashboard" in job.metadata.annotations
-                and job_is_active(job)
-            ):
-                print(f"Found already underway dashboard job for: {target.name}.")
-                return  # Do not submit another job.
-
-        if get_dashboard_report_age(target.name) < timedelta(minutes=10):
-            # https://github.com/cp2k/cp2k/blob/c7c47bf/tools/docker/generate_dockerfiles.py#L349
-            print(f"Found too recent dashboard report for: {target.name}.")
-            return  # Hold off to avoid confusing the report cache.
-
-        if get_dashboard_report_sha(target.name) == head_sha:
-            print(f"Found up-to-date dashboard report for: {target.name}.")
-            return  # No need to submit another job.
-
-        if target.cache_from:
-            if get_dashboard_report_sha(target.cache_from) != head_sha:
-                print(f"Found stale cache_from dashboard report for: {target.name}.")
-                return  # Won't submit a job without up-to-date cache_from image.
-
-    # Finally submit a new job.
+    # Check if a dashboard job for given target is already underway.
+    for job in job_index.list_target_jobs(target.name):
+        if "cp2kci-dashboard" in job.metadata.annotations and job_is_active(job):
+            print(f"Found already underway dashboard job for: {target.name}.")
+            return "skip"  # Do not submit another job.
+
+    entry = get_dashboard_entry(manifest, target.name)
+    if entry and get_dashboard_report_age(entry) < timedelta(minutes=10):
+        # https://github.com/cp2k/cp2k/blob/c7c47bf/tools/docker/generate_dockerfiles.py#L349
+        print(f"Found too recent dashboard report for: {target.name}.")
+        return "skip"  # Hold off to avoid confusing the report cache.
+
+    if entry and entry["git_sha"] == head_sha:
+        print(f"Found up-to-date dashboard report for: {target.name}.")
+        return "skip"  # No need to submit another job.
+
+    if target.cache_from:
+        cache_from_entry = get_dashboard_entry(manifest, target.cache_from)
+        if cache_from_entry and cache_from_entry["git_sha"] == head_sha:
+            return "submit"
+        if target.cache_from in scheduled or dashboard_test_pending(
+            target.cache_from, head_sha
+        ):
+            print(f"Deferring {target.name} until {target.cache_from} is published.")
+            return "defer"  # Gets released by publish_job_to_dashboard().
+        print(f"Found stale cache_from dashboard report for: {target.name}.")
+        return "skip"  # Won't submit a job without up-to-date cache_from image.
+
+    return "submit"
+
+
+# ======================================================================================
+def dashboard_test_pending(target_name: TargetName, head_sha: str) -> bool:
+    # Checks if a dashboard test for given target and commit is underway or deferred.
+    for job in job_index.list_target_jobs(target_name):
+        annotations = job.metadata.annotations
+        if "cp2kci-dashboard" in annotations and job_is_active(job):
+            if annotations.get("cp2kci-git-ref") == head_sha:
+                return True
+    with deferred_dashboard_tests_lock:
+        deferred = deferred_dashboard_tests.get(target_name)
+        return deferred is not None and deferred.head_sha == head_sha
+
+
+# ======================================================================================
+def release_dashboard_tests(base_name: TargetName, git_sha: Optional[str]) -> None:
+    with deferred_dashboard_tests_lock:
+        released = [
+            d
+            for d in deferred_dashboard_tests.values()
+            if d.target.cache_from == base_name
+        ]
+        for deferred in released:
+            del deferred_dashboard_tests[deferred.target.name]
+
+    ready: List[Target] = []
+    for deferred in released:
+        if deferred.head_sha == git_sha:
+            ready.append(deferred.target)
+        else:
+            print(f"Dropping {deferred.target.name}, {base_name} is at another commit.")
+
+    if ready and git_sha:
+        print(f"Releasing {len(ready)} dashboard tests that wait for {base_name}.")
+        task = functools.partial(submit_dashboard_tests, ready, git_sha)
+        rpc_queue.submit(None, task)
+
+
+# ======================================================================================
+def start_dashboard_test(
+    target: Target,
+    head_sha: str,
+    force: bool,
+    job_name: Optional[str] = None,
+    upload_urls: Optional[RunUploadUrls] = None,
+) -> None:
+    assert target.repository == "cp2k"
     job_annotations = {"cp2kci-dashboard": "yes"}
     if force:
         job_annotations["cp2kci-force"] = "yes"
-    kubeutil.submit_run(target, "master", head_sha, job_annotations)
+    new_job = kubeutil.submit_run(
+        target,
+        "master",
+        head_sha,
+        job_annotations,
+        job_name=job_name,
+        upload_urls=upload_urls,
+    )
+    job_index.add(new_job)
 
 
 # ======================================================================================
-def get_dashboard_report_age(target_name: TargetName) -> timedelta:
+def get_dashboard_report_age(entry: DashboardEntry) -> timedelta:
+    return datetime.now(timezone.utc) - datetime.fromisoformat(entry["updated"])
+
+
+# ======================================================================================
+def get_dashboard_entry(
+    manifest: Manifest, target_name: TargetName
+) -> Optional[DashboardEntry]:
+    if target_name not in manifest:
+        # Fall back to the report itself, e.g. if it was published before the manifest.
+        entry = probe_dashboard_report(target_name)
+        if not entry:
+            return None  # Report not found.
+        manifest[target_name] = entry  # Remember for subsequent lookups.
+    return manifest[target_name]
+
+
+# ======================================================================================
+def probe_dashboard_report(target_name: TargetName) -> Optional[DashboardEntry]:
     assert target_name.startswith("cp2k-")
     test_name = target_name[5:]
     blob = output_bucket.get_blob("dashboard_" + test_name + "_report.txt")
-    if blob:
-        return datetime.now(timezone.utc) - cast(datetime, blob.updated)
-    return timedelta.max  # Blob not found.
+    return parse_dashboard_report(blob) if blob else None
 
 
 # ======================================================================================
-def get_dashboard_report_sha(target_name: TargetName) -> Optional[str]:
-    assert target_name.startswith("cp2k-")
-    test_name = target_name[5:]
+def parse_dashboard_report(blob: Any) -> DashboardEntry:
+    report = parse_report(blob)
+    updated = cast(datetime, blob.updated).isoformat()
+    return {"git_sha": report.git_sha, "updated": updated, "status": report.status}
 
-    # Downloading first 1kb of report should be enough to read CommitSHA.
-    blob = output_bucket.get_blob("dashboard_" + test_name + "_report.txt")
-    if blob:
-        # We only download the first 1024 bytes which might break a unicode character.
-        report = blob.download_as_string(end=1024).decode("utf8", errors="replace")
-        m = re.search(r"(^|\n)CommitSHA: (\w{40})\n", report)
-        if m:
-            return str(m.group(2))
 
-    return None  # Blob or CommitSHA not found.
+# ======================================================================================
+def rebuild_dashboard_manifest() -> None:
+    rebuilt: Manifest = {}
+    for blob in output_bucket.list_blobs(match_glob="dashboard_*_report.txt"):
+        test_name = blob.name[len("dashboard_") : -len("_report.txt")]
+        rebuilt[TargetName("cp2k-" + test_name)] = parse_dashboard_report(blob)
+
+    def apply(manifest: Manifest) -> None:
+        # Keep entries that got published while we were probing the reports.
+        for target_name, entry in rebuilt.items():
+            current = manifest.get(target_name)
+            age = get_dashboard_report_age
+            if not current or age(current) > age(entry):
+                manifest[target_name] = entry
+        for target_name in list(manifest):
+            if target_name not in rebuilt:
+                del manifest[target_name]
+
+    dashboard_manifest.modify(apply)
+    print(f"Rebuilt dashboard manifest with {len(rebuilt)} entries.")
 
 
 # ======================================================================================
-def poll_pull_requests(job_list: V1JobList) -> None:
+def poll_pull_requests() -> None:
     """A save guard in case we're missing a callback or loosing BatchJob"""
 
     active_check_runs_urls = []
-    for job in job_list.items:
+    for job in job_index.list_jobs():
         annotations = job.metadata.annotations
         if job_is_active(job) and "cp2kci-check-run-url" in annotations:
             active_check_runs_urls.append(annotations["cp2kci-check-run-url"])
 
     for repo_config in REPOSITORY_CONFIGS:
         gh = GithubUtil(repo_config.name)
-        for pr in gh.iterate_pull_requests():
-            if pr["base"]["ref"] != "master":
-                continue  # ignore non-master PR
-            head_sha = pr["head"]["sha"]
-
-            check_runs = list(gh.iterate_check_runs(f"/commits/{head_sha}/check-runs"))
+        # Only non-master PRs are ignored, hence we ask for master PRs directly.
+        for pr, check_runs in gh.iterate_pull_requests_with_check_runs("master"):
             for check_run in check_runs:
-                if check_run["app"]["owner"]["login"] != "cp2k":
+                if not gh.is_own_app(check_run["app"]):
                     continue  # Ignore other apps like e.g. "packit".
                 if check_run["status"] == "completed":
                     continue  # Good, check_run is completed.
                 if check_run["url"] in active_check_runs_urls:
                     continue  # Good, there is still an active BatchJob.
-                if gh.age(check_run["started_at"]) < timedelta(minutes=3):
+                if gh.age(check_run.get("started_at", gh.now())) < timedelta(minutes=3):
                     continue  # It's still young - wait a bit.
 
                 print("Found forgotten check_run: {}".format(check_run["url"]))
@@ -696,15 +1204,20 @@ def poll_pull_requests(job_list: V1JobList) -> None:
             pr_is_old = gh.age(pr["created_at"]) > timedelta(minutes=3)
             if pr_is_old and not check_runs:
                 print("Found forgotten PR: {}".format(pr["number"]))
-                process_pull_request(gh, pr["number"], pr["user"]["login"])
+                # Run in the PR's lane of the work queue, like the webhook events.
+                key = (repo_config.name, pr["number"])
+                sender = pr["user"]["login"]
+                task = functools.partial(process_pull_request, gh, pr["number"], sender)
+                rpc_queue.submit(key, task, coalesce_tag="process_pull_request")
 
 
 # ======================================================================================
 def record_job_start_time(job: V1Job) -> None:
     job_annotations = job.metadata.annotations
     if "cp2kci-started" not in job_annotations:
-        report_blob = output_bucket.get_blob(job_annotations["cp2kci-report-path"])
-        if report_blob.size and report_blob.size > 100:
+        # The state of waiting jobs' reports is refreshed at the beginning of each tick.
+        report_state = storage.lookup(report_path(job))
+        if report_state and report_state.size > 100:
             job_annotations["cp2kci-started"] = kubeutil.now()
             kubeutil.patch_job_annotations(job.metadata.name, job_annotations)
 
@@ -724,13 +1237,24 @@ def publish_job_to_dashboard(job: V1Job) -> None:
     assert target_name.startswith("cp2k-")
     test_name = target_name[5:]
 
-    src_blob = output_bucket.blob(job_annotations["cp2kci-report-path"])
-    if src_blob.exists():
+    git_sha: Optional[str] = None
+    src_path = report_path(job)
+    if storage.lookup(src_path):
+        src_blob = output_bucket.blob(src_path)
         dest_blob = output_bucket.blob("dashboard_" + test_name + "_report.txt")
         dest_blob.rewrite(src_blob)
+        report = parse_report(src_blob)
+        entry: DashboardEntry = {
+            "git_sha": report.git_sha,
+            "updated": kubeutil.now(),
+            "status": report.status,
+        }
+        dashboard_manifest.update(target_name, entry)
+        git_sha = report.git_sha
 
-    src_blob = output_bucket.blob(job_annotations["cp2kci-artifacts-path"])
-    if src_blob.exists():
+    src_path = job_annotations["cp2kci-artifacts-path"]
+    if storage.lookup(src_path):
+        src_blob = output_bucket.blob(src_path)
         dest_blob = output_bucket.blob("dashboard_" + test_name + "_artifacts.zip")
         dest_blob.rewrite(src_blob)
 
@@ -738,6 +1262,9 @@ def publish_job_to_dashboard(job: V1Job) -> None:
     job_annotations["cp2kci-dashboard-published"] = "yes"
     kubeutil.patch_job_annotations(job.metadata.name, job_annotations)
 
+    # submit the targets that build upon this one
+    release_dashboard_tests(TargetName(target_name), git_sha)
+
 
 # ======================================================================================
 def build_restart_actions() -> List[CheckRunAction]:
@@ -780,10 +1307,10 @@ def publish_job_to_github(job: V1Job) -> None:
         summary = f"[Detailed Report]({report_blob.public_url})"
         # Did the run upload artifacts?
         artifacts_path = job_annotations["cp2kci-artifacts-path"]
-        artifacts_blob = output_bucket.get_blob(artifacts_path)
-        if artifacts_blob:
-            size_mib = artifacts_blob.size / 1024 / 1024
-            download_url = artifacts_blob.public_url
+        artifacts_state = storage.lookup(artifacts_path)
+        if artifacts_state:
+            size_mib = artifacts_state.size / 1024 / 1024
+            download_url = output_bucket.blob(artifacts_path).public_url
             browse_url = f"https://ci.cp2k.org/artifacts/{artifacts_path[:-14]}/"
             summary += f"\n\n[Browse Artifacts]({browse_url})"
             summary += f"\n\n[Download Artifacts ({size_mib:.1f} MiB)]({download_url})"
@@ -815,10 +1342,21 @@ def publish_job_to_github(job: V1Job) -> None:
 def parse_report(report_blob: Any) -> Report:
     report = Report(status="UNKNOWN", summary="", git_sha=None)
     try:
-        text = report_blob.download_as_string().decode("utf8")
-        report.summary = re.findall(r"(^|\n|\r)Summary: (.+?)[\n\r]", text)[-1][1]
-        report.status = re.findall(r"(^|\n|\r)Status: (.+?)[\n\r]", text)[-1][1]
-        report.git_sha = re.findall(r"(^|\n|\r)CommitSHA: (.+?)[\n\r]", text)[0][1]
+        # Usually the trailer suffices, which requires only a small tail of the report.
+        tail = report_blob.download_as_bytes(start=-REPORT_TAIL_SIZE)
+        report.bytes_read = len(tail)
+        trailer: Dict[str, str] = {}
+        for line in re.split(r"[\n\r]", tail.decode("utf8", errors="replace")):
+            key, _, value = line.partition(": ")
+            if key in REPORT_TRAILER_FIELDS:
+                trailer[key] = value
+        if len(trailer) == len(REPORT_TRAILER_FIELDS):
+            report.summary = trailer["CP2K-CI-Summary"]
+            report.status = trailer["CP2K-CI-Status"]
+            report.git_sha = trailer["CP2K-CI-CommitSHA"]
+        else:
+            parse_legacy_report(report_blob, report)
+        print(f"Parsed report {report_blob.name} from {report.bytes_read} bytes.")
         assert report.git_sha and len(report.git_sha) == 40
     except:
         report.summary = "Error while retrieving report."
@@ -828,10 +1366,21 @@ def parse_report(report_blob: Any) -> Report:
 
 
 # ======================================================================================
-def job_is_active(job: V1Job) -> bool:
-    # https://kubernetes.io/docs/reference/generated/kubernetes-api/v1.25/#jobstatus-v1-batch
-    conditions = [c.type for c in job.status.conditions or []]
-    return "Complete" not in conditions and "Failed" not in conditions
+def parse_legacy_report(report_blob: Any, report: Report) -> None:
+    # Streams through reports without trailer, i.e. those of older runners.
+    summary, status, git_sha = None, None, None
+    with report_blob.open("rb", chunk_size=256 * 1024) as f:
+        for raw_line in f:
+            report.bytes_read += len(raw_line)
+            for line in raw_line.decode("utf8", errors="replace").split("\r"):
+                if line.startswith("Summary: "):
+                    summary = line[9:].rstrip("\n")
+                elif line.startswith("Status: "):
+                    status = line[8:].rstrip("\n")
+                elif line.startswith("CommitSHA: ") and git_sha is None:
+                    git_sha = line[11:].rstrip("\n")
+    assert summary is not None and status is not None
+    report.summary, report.status, report.git_sha = summary, status, git_sha
 
 
 # ======================================================================================
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+# author: Ole Schuett
+
+import io
+import os
+import sys
+import json
+import argparse
+import statistics
+from time import monotonic, sleep
+from collections import Counter
+from contextlib import redirect_stdout
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, TextIO
+
+import fake_services
+from fake_services import FakeBatchApi, FakeGithub, FakeService, FakeStorageClient
+
+fake_services.setup_github_app_env()  # has to happen before github_util is imported
+
+import backend
+import github_util
+from job_index import job_state
+
+
+# ======================================================================================
+class FakeMessage:
+    """Stand-in for a Pub/Sub message, which remembers when it got acknowledged."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.received = monotonic()
+        self.acked: Optional[float] = None
+
+    # --------------------------------------------------------------------------
+    def ack(self) -> None:
+        self.acked = monotonic()
+
+
+# ======================================================================================
+@dataclass
+class PhaseResult:
+    name: str
+    events: int
+    wall_time: float
+    ack_latencies: List[float]
+    tick_durations: List[float]
+    calls: Dict[str, Counter[str]] = field(default_factory=dict)
+
+
+# ======================================================================================
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the backend with fakes.")
+    parser.add_argument("--prs", type=int, default=20, help="open pull requests")
+    parser.add_argument("--targets", type=int, default=10, help="targets per PR")
+    parser.add_argument("--pushes", type=int, default=3, help="pushes per PR in storm")
+    parser.add_argument("--latency", type=float, default=0, help="per API call in ms")
+    parser.add_argument(
+        "--mergeability-delay", type=float, default=0.5, help="after push in s"
+    )
+    parser.add_argument("--tick-interval", type=float, default=0.1, help="in seconds")
+    parser.add_argument("--timeout", type=float, default=300, help="per phase in s")
+    parser.add_argument("--details", action="store_true", help="calls per endpoint")
+    parser.add_argument("--verbose", action="store_true", help="show backend output")
+    args = parser.parse_args()
+
+    out = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        with redirect_stdout(out if args.verbose else devnull):
+            results = Benchmark(args).run()
+    print_results(results, args.details, out)
+
+
+# ======================================================================================
+def targets_config(num_targets: int) -> str:
+    config = io.StringIO()
+    for i in range(num_targets):
+        config.write(f"[target-{i:02d}]\n")
+        config.write(f"display_name = Target {i}\n")
+        config.write("cpu = 8\n")
+        config.write("nodepools = pool-a pool-b\n")
+        config.write(f"dockerfile = /tools/docker/Dockerfile.target_{i}\n")
+        config.write("build_path = /\n")
+        config.write("trigger_path = src/\n\n")
+    return config.getvalue()
+
+
+# ======================================================================================
+class Benchmark:
+    """Drives the backend through a scenario of N PRs with M targets each."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.num_jobs = args.prs * args.targets
+        self.cycle = 0
+        latency = args.latency / 1e3
+        config = targets_config(args.targets)
+        self.github = FakeGithub(config, latency, args.mergeability_delay)
+        self.batch_api = FakeBatchApi(latency)
+        self.storage_client = FakeStorageClient(latency)
+        self.services: Dict[str, FakeService] = {
+            "github": self.github,
+            "kubernetes": self.batch_api,
+            "gcs": self.storage_client,
+        }
+
+        github_util.set_http_session(self.github)
+        backend.init_services(
+            project="benchmark",
+            client=self.storage_client,
+            batch_api=self.batch_api,
+            watch_factory=self.batch_api.new_watch,
+            signing_credentials=object(),
+        )
+        backend.job_index.start()
+        self.bucket = self.storage_client.buckets["cp2k-ci"]
+
+    # --------------------------------------------------------------------------
+    def run(self) -> List[PhaseResult]:
+        return [
+            self.run_phase("open", self.open_pull_requests, self.jobs_submitted),
+            self.run_phase("push storm", self.push_storm, self.jobs_submitted),
+            self.run_phase("start jobs", self.start_jobs, self.jobs_running),
+            self.run_phase("finish jobs", self.finish_jobs, self.jobs_finished),
+        ]
+
+    # --------------------------------------------------------------------------
+    def run_phase(
+        self,
+        name: str,
+        action: Callable[[], List[FakeMessage]],
+        done: Callable[[], bool],
+    ) -> PhaseResult:
+        calls_before = {k: s.calls.copy() for k, s in self.services.items()}
+        start = monotonic()
+        messages = action()
+        events = len(messages) or self.num_jobs
+        tick_durations = self.tick_until(lambda: all_acked(messages) and done())
+        wall_time = monotonic() - start
+        ack_latencies = [m.acked - m.received for m in messages if m.acked]
+        calls = {k: s.calls - calls_before[k] for k, s in self.services.items()}
+        return PhaseResult(
+            name, events, wall_time, ack_latencies, tick_durations, calls
+        )
+
+    # --------------------------------------------------------------------------
+    def tick_until(self, done: Callable[[], bool]) -> List[float]:
+        durations = []
+        deadline = monotonic() + self.args.timeout
+        while True:
+            start = monotonic()
+            backend.tick(self.cycle)
+            durations.append(monotonic() - start)
+            self.cycle += 1
+            if done():
+                return durations
+            if monotonic() > deadline:
+                raise TimeoutError(f"Scenario got stuck after {len(durations)} ticks.")
+            sleep(self.args.tick_interval)
+
+    # --------------------------------------------------------------------------
+    def send_event(self, pr_number: int, action: str) -> FakeMessage:
+        body = self.github.pull_request_event(pr_number, action)
+        rpc = {"rpc": "github_event", "event": "pull_request", "body": body}
+        message = FakeMessage(json.dumps(rpc).encode("utf8"))
+        backend.process_pubsub_message(message)
+        return message
+
+    # --------------------------------------------------------------------------
+    def open_pull_requests(self) -> List[FakeMessage]:
+        pr_numbers = [self.github.open_pull_request() for _ in range(self.args.prs)]
+        return [self.send_event(n, "opened") for n in pr_numbers]
+
+    # --------------------------------------------------------------------------
+    def push_storm(self) -> List[FakeMessage]:
+        messages = []
+        for _ in range(self.args.pushes):
+            for pr_number in self.github.pull_requests:
+                self.github.push(pr_number)
+                messages.append(self.send_event(pr_number, "synchronize"))
+        return messages
+
+    # --------------------------------------------------------------------------
+    def start_jobs(self) -> List[FakeMessage]:
+        # The runners upload their first report right after the job got scheduled.
+        for job in backend.job_index.list_jobs():
+            report = b"Starting runner...\n" * 20
+            self.bucket.put_object(backend.report_path(job), report)
+        return []
+
+    # --------------------------------------------------------------------------
+    def finish_jobs(self) -> List[FakeMessage]:
+        for job in backend.job_index.list_jobs():
+            git_sha = fake_services.new_sha(job.metadata.name)
+            report = b"Starting runner...\n" * 20
+            report += b"CP2K-CI-Summary: All good\n"
+            report += b"CP2K-CI-Status: OK\n"
+            report += b"CP2K-CI-CommitSHA: " + git_sha.encode("utf8") + b"\n"
+            self.bucket.put_object(backend.report_path(job), report)
+            self.batch_api.complete_job(job.metadata.name)
+        return []
+
+    # --------------------------------------------------------------------------
+    def active_check_runs(self) -> int:
+        num_check_runs = len(self.github.head_check_runs())
+        return num_check_runs - self.github.count_check_runs("completed")
+
+    # --------------------------------------------------------------------------
+    def jobs_submitted(self) -> bool:
+        num_jobs = len(backend.job_index.list_jobs())
+        return num_jobs == self.num_jobs and self.active_check_runs() == num_jobs
+
+    # --------------------------------------------------------------------------
+    def jobs_running(self) -> bool:
+        jobs = backend.job_index.list_jobs()
+        return all(job_state(job) == "running" for job in jobs)
+
+    # --------------------------------------------------------------------------
+    def jobs_finished(self) -> bool:
+        return not self.batch_api.jobs and self.active_check_runs() == 0
+
+
+# ======================================================================================
+def all_acked(messages: List[FakeMessage]) -> bool:
+    return all(m.acked for m in messages)
+
+
+# ======================================================================================
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+# ======================================================================================
+def print_results(results: List[PhaseResult], details: bool, out: TextIO) -> None:
+    header = f"{'phase':<12} {'events':>6} {'wall':>7} {'events/s':>8}"
+    header += f" {'ack p50/p90/max [ms]':>22} {'ticks':>5} {'tick p50/max [ms]':>18}"
+    header += f" {'github':>7} {'k8s':>5} {'gcs':>5}  (calls per event)"
+    print(header, file=out)
+    for r in results:
+        acks = [1e3 * percentile(r.ack_latencies, p) for p in (50, 90, 100)]
+        ticks = [1e3 * percentile(r.tick_durations, p) for p in (50, 100)]
+        per_event = [sum(r.calls[s].values()) / r.events for s in r.calls]
+        line = f"{r.name:<12} {r.events:>6} {r.wall_time:>6.2f}s"
+        line += f" {r.events / r.wall_time:>8.1f}"
+        line += " {:>22}".format(
+            "/".join(f"{a:.0f}" for a in acks) if r.ack_latencies else "-"
+        )
+        line += f" {len(r.tick_durations):>5}"
+        line += " {:>18}".format("/".join(f"{t:.0f}" for t in ticks))
+        line += " {:>7.1f} {:>5.1f} {:>5.1f}".format(*per_event)
+        print(line, file=out)
+
+    if details:
+        for r in results:
+            print(f"\nCalls during phase '{r.name}':", file=out)
+            for service, calls in r.calls.items():
+                for endpoint, count in calls.most_common():
+                    print(f"  {service:<11} {count:>6}  {endpoint}", file=out)
+
+    tick_durations = [d for r in results for d in r.tick_durations]
+    print(
+        f"\nTick duration mean: {1e3 * statistics.mean(tick_durations):.1f}ms", file=out
+    )
+
+
+# ======================================================================================
+if __name__ == "__main__":
+    main()
+
+# EOF
@@ -0,0 +1,71 @@
+# author: Ole Schuett
+
+import json
+from typing import Any, Callable, Dict, Optional, Tuple, TypedDict
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from target import TargetName
+
+MANIFEST_PATH = "dashboard_manifest.json"
+MAX_UPDATE_ATTEMPTS = 10
+
+
+# ======================================================================================
+class DashboardEntry(TypedDict):
+    git_sha: Optional[str]
+    updated: str  # ISO 8601
+    status: str
+
+
+Manifest = Dict[TargetName, DashboardEntry]
+
+
+# ======================================================================================
+class DashboardManifest:
+    """Summary of all published dashboard reports, stored in a single blob.
+
+    Concurrent updates are serialized via generation preconditions.
+    """
+
+    def __init__(self, bucket: Any):
+        self.bucket = bucket
+
+    # --------------------------------------------------------------------------
+    def read(self) -> Tuple[Manifest, int]:
+        blob = self.bucket.blob(MANIFEST_PATH)
+        try:
+            data = blob.download_as_bytes()
+        except NotFound:
+            return {}, 0  # Generation zero lets the first write create the blob.
+        manifest: Manifest = json.loads(data)
+        return manifest, int(blob.generation)
+
+    # --------------------------------------------------------------------------
+    def update(self, target_name: TargetName, entry: DashboardEntry) -> None:
+        def apply(manifest: Manifest) -> None:
+            manifest[target_name] = entry
+
+        self.modify(apply)
+
+    # --------------------------------------------------------------------------
+    def modify(self, apply: Callable[[Manifest], None]) -> None:
+        for _ in range(MAX_UPDATE_ATTEMPTS):
+            manifest, generation = self.read()
+            apply(manifest)
+            blob = self.bucket.blob(MANIFEST_PATH)
+            blob.cache_control = "no-cache"
+            data = json.dumps(manifest, indent=1, sort_keys=True)
+            try:
+                blob.upload_from_string(
+                    data,
+                    content_type="application/json",
+                    if_generation_match=generation,
+                )
+                return
+            except PreconditionFailed:
+                print("Dashboard manifest got modified concurrently, retrying.")
+        raise Exception("Could not update dashboard manifest.")
+
+
+# EOF
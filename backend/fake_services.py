@@ -0,0 +1,716 @@
+# author: Ole Schuett
+
+import io
+import os
+import re
+import json
+import copy
+import fnmatch
+import hashlib
+import tempfile
+import threading
+from time import monotonic, sleep
+from base64 import b64encode
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from kubernetes.client import Configuration
+from kubernetes.client.rest import ApiException
+from kubernetes.client.models.v1_job import V1Job
+from kubernetes.client.models.v1_job_list import V1JobList
+from kubernetes.client.models.v1_job_status import V1JobStatus
+from kubernetes.client.models.v1_job_condition import V1JobCondition
+from kubernetes.client.models.v1_list_meta import V1ListMeta
+
+from metrics import normalize_endpoint
+
+REPO_URL = "https://api.github.com/repos/cp2k/cp2k"
+
+Handler = Callable[..., Tuple[int, Any]]
+T = TypeVar("T")
+
+# Shared by all cloned Kubernetes models, deepcopy would copy it for each of them.
+MODEL_CONFIGURATION = Configuration()
+MODEL_CONFIGURATION.client_side_validation = False
+
+
+# ======================================================================================
+def setup_github_app_env() -> None:
+    # The GitHub app's credentials are read by github_util, hence call before import.
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    key_file = tempfile.NamedTemporaryFile(suffix=".pem", delete=False)
+    key_file.write(pem)
+    key_file.close()
+    os.environ["GITHUB_APP_ID"] = "16828"
+    os.environ["GITHUB_APP_INSTALL_ID"] = "312256"
+    os.environ["GITHUB_APP_KEY"] = key_file.name
+
+
+# ======================================================================================
+def new_sha(seed: str) -> str:
+    return hashlib.sha1(seed.encode("utf8")).hexdigest()
+
+
+# ======================================================================================
+def now() -> datetime:
+    return datetime.now(timezone.utc).replace(microsecond=0)
+
+
+# ======================================================================================
+class FakeService:
+    """Counts the calls to a fake service and delays each by a simulated latency."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.calls: Counter[str] = Counter()
+
+    # --------------------------------------------------------------------------
+    def record_call(self, name: str) -> None:
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency:
+            sleep(self.latency)
+
+
+# ======================================================================================
+@dataclass
+class FakePullRequest:
+    number: int
+    commits: List[str]
+    created_at: str
+    pushed_at: float = field(default_factory=monotonic)
+    mergeable: Optional[bool] = None  # overrides the mergeability delay if set
+
+    @property
+    def head_sha(self) -> str:
+        return self.commits[-1]
+
+
+# ======================================================================================
+class FakeGithub(FakeService):
+    """Stand-in for the parts of the GitHub API that the backend uses.
+
+    Can be injected via github_util.set_http_session() as it mimics requests.Session.
+    Like GitHub, it reports "mergeable" as None for a while after each push.
+    """
+
+    def __init__(
+        self, targets_config: str, latency: float, mergeability_delay: float = 0
+    ):
+        super().__init__(latency)
+        self.mergeability_delay = mergeability_delay
+        self.targets_config = targets_config.encode("utf8")
+        self.master_sha = new_sha("master")
+        self.pull_requests: Dict[int, FakePullRequest] = {}
+        self.check_runs: Dict[int, Dict[str, Any]] = {}
+        self.rate_limit_remaining = 5000
+        self.routes: List[Tuple[str, str, Handler]] = [
+            ("POST", r"/app/installations/\d+/access_tokens", self.create_token),
+            ("GET", r"/repos/cp2k/cp2k/pulls/(\d+)", self.get_pull),
+            ("GET", r"/repos/cp2k/cp2k/pulls/(\d+)/commits", self.get_pull_commits),
+            ("GET", r"/repos/cp2k/cp2k/pulls/(\d+)/files", self.get_pull_files),
+            ("GET", r"/repos/cp2k/cp2k/commits", self.get_commits),
+            ("GET", r"/repos/cp2k/cp2k/commits/(\w+)/check-runs", self.get_check_runs),
+            ("GET", r"/repos/cp2k/cp2k/contents/.+", self.get_contents),
+            ("POST", r"/repos/cp2k/cp2k/check-runs", self.post_check_run),
+            ("PATCH", r"/repos/cp2k/cp2k/check-runs/(\d+)", self.patch_check_run),
+            ("POST", r"/graphql", self.graphql),
+            ("GET", r"/orgs/cp2k/members/.+", self.get_member),
+        ]
+
+    # --------------------------------------------------------------------------
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: Dict[str, str],
+        json: Any = None,
+        timeout: float = 0,
+    ) -> requests.Response:
+        self.record_call(f"{method} {normalize_endpoint(url)}")
+        parts = urlsplit(url)
+        query = parse_qs(parts.query)
+        status, body = 404, {"message": "Not Found"}
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, parts.path)
+            if route_method == method and match:
+                with self.lock:
+                    status, body = handler(query, json, *match.groups())
+                break
+        return self.response(method, url, headers, status, body)
+
+    # --------------------------------------------------------------------------
+    def response(
+        self, method: str, url: str, headers: Dict[str, str], status: int, body: Any
+    ) -> requests.Response:
+        content = json.dumps(body).encode("utf8") if body is not None else b""
+        response_headers = {}
+        if method == "GET" and status == 200:
+            etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+            response_headers["ETag"] = etag
+            if headers.get("If-None-Match") == etag:
+                status, content = 304, b""
+        if status != 304:  # Conditional requests are free.
+            with self.lock:
+                self.rate_limit_remaining -= 1
+        response_headers["X-RateLimit-Remaining"] = str(self.rate_limit_remaining)
+
+        r = requests.Response()
+        r.status_code = status
+        r._content = content
+        r.headers = CaseInsensitiveDict(response_headers)
+        r.url = url
+        r.encoding = "utf8"
+        r.elapsed = timedelta(seconds=self.latency)
+        r.request = requests.Request(method, url).prepare()
+        return r
+
+    # --------------------------------------------------------------------------
+    def open_pull_request(self) -> int:
+        with self.lock:
+            number = len(self.pull_requests) + 1
+            head_sha = new_sha(f"pr-{number}-commit-1")
+            created_at = now().isoformat()
+            pr = FakePullRequest(number, commits=[head_sha], created_at=created_at)
+            self.pull_requests[number] = pr
+            return number
+
+    # --------------------------------------------------------------------------
+    def push(self, number: int) -> None:
+        with self.lock:
+            pr = self.pull_requests[number]
+            pr.commits.append(new_sha(f"pr-{number}-commit-{len(pr.commits) + 1}"))
+            pr.pushed_at = monotonic()
+            pr.mergeable = None
+
+    # --------------------------------------------------------------------------
+    def set_mergeable(self, number: int, mergeable: Optional[bool]) -> None:
+        with self.lock:
+            self.pull_requests[number].mergeable = mergeable
+
+    # --------------------------------------------------------------------------
+    def is_mergeable(self, pr: FakePullRequest) -> Optional[bool]:
+        if pr.mergeable is not None:
+            return pr.mergeable
+        if monotonic() - pr.pushed_at >= self.mergeability_delay:
+            return True
+        return None  # GitHub is still computing the merge commit.
+
+    # --------------------------------------------------------------------------
+    def pull_request_event(self, number: int, action: str) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "action": action,
+                "pull_request": self.pull_json(self.pull_requests[number]),
+                "repository": {"name": "cp2k"},
+                "sender": {"id": 1, "login": "octocat"},
+            }
+
+    # --------------------------------------------------------------------------
+    def count_check_runs(self, status: str) -> int:
+        with self.lock:
+            return sum(1 for r in self.head_check_runs() if r["status"] == status)
+
+    # --------------------------------------------------------------------------
+    def head_check_runs(self) -> List[Dict[str, Any]]:
+        # Check runs of outdated commits are no longer shown by GitHub.
+        with self.lock:
+            heads = [pr.head_sha for pr in self.pull_requests.values()]
+            return [r for sha in heads for r in self.latest_check_runs(sha)]
+
+    # --------------------------------------------------------------------------
+    def latest_check_runs(self, head_sha: str) -> List[Dict[str, Any]]:
+        # Like GitHub, only the most recent check run of each name is considered.
+        with self.lock:
+            runs = [r for r in self.check_runs.values() if r["head_sha"] == head_sha]
+            return list({r["name"]: r for r in runs}.values())
+
+    # --------------------------------------------------------------------------
+    def pull_json(self, pr: FakePullRequest) -> Dict[str, Any]:
+        url = f"{REPO_URL}/pulls/{pr.number}"
+        return {
+            "number": pr.number,
+            "url": url,
+            "html_url": f"https://github.com/cp2k/cp2k/pull/{pr.number}",
+            "commits_url": url + "/commits",
+            "head": {"sha": pr.head_sha},
+            "base": {"ref": "master"},
+            "created_at": pr.created_at,
+            "mergeable": self.is_mergeable(pr),
+            "merged": False,
+            "user": {"id": 1, "login": "octocat"},
+        }
+
+    # --------------------------------------------------------------------------
+    def commit_json(self, sha: str, parents: List[str]) -> Dict[str, Any]:
+        url = f"{REPO_URL}/commits/{sha}"
+        return {"sha": sha, "url": url, "parents": [{"sha": p} for p in parents]}
+
+    # --------------------------------------------------------------------------
+    def create_token(self, query: Any, body: Any) -> Tuple[int, Any]:
+        expires_at = now() + timedelta(hours=1)
+        return 201, {"token": "fake-token", "expires_at": expires_at.isoformat()}
+
+    # --------------------------------------------------------------------------
+    def get_pull(self, query: Any, body: Any, number: str) -> Tuple[int, Any]:
+        return 200, self.pull_json(self.pull_requests[int(number)])
+
+    # --------------------------------------------------------------------------
+    def get_pull_commits(self, query: Any, body: Any, number: str) -> Tuple[int, Any]:
+        shas = [self.master_sha] + self.pull_requests[int(number)].commits
+        return 200, [self.commit_json(c, [p]) for p, c in zip(shas, shas[1:])]
+
+    # --------------------------------------------------------------------------
+    def get_pull_files(self, query: Any, body: Any, number: str) -> Tuple[int, Any]:
+        return 200, [{"filename": "src/motion/md_run.F"}]
+
+    # --------------------------------------------------------------------------
+    def get_commits(self, query: Dict[str, List[str]], body: Any) -> Tuple[int, Any]:
+        ref = query["sha"][0]
+        match = re.fullmatch(r"pull/(\d+)/merge", ref)
+        if match:
+            pr = self.pull_requests[int(match.group(1))]
+            head_sha = pr.head_sha
+            if self.is_mergeable(pr) is None and len(pr.commits) > 1:
+                head_sha = pr.commits[-2]  # The merge branch is still outdated.
+            merge_sha = new_sha(f"merge-{head_sha}")
+            return 200, [self.commit_json(merge_sha, [self.master_sha, head_sha])]
+        return 200, [self.commit_json(self.master_sha, [new_sha("master-parent")])]
+
+    # --------------------------------------------------------------------------
+    def get_check_runs(self, query: Any, body: Any, sha: str) -> Tuple[int, Any]:
+        runs = self.latest_check_runs(sha)
+        return 200, {"total_count": len(runs), "check_runs": runs}
+
+    # --------------------------------------------------------------------------
+    def get_contents(self, query: Any, body: Any) -> Tuple[int, Any]:
+        sha = hashlib.sha1(self.targets_config).hexdigest()
+        return 200, {"sha": sha, "content": b64encode(self.targets_config).decode()}
+
+    # --------------------------------------------------------------------------
+    def post_check_run(self, query: Any, body: Dict[str, Any]) -> Tuple[int, Any]:
+        run_id = len(self.check_runs) + 1
+        check_run: Dict[str, Any] = {"conclusion": None, "completed_at": None}
+        check_run.update(copy.deepcopy(body))
+        check_run["id"] = run_id
+        check_run["url"] = f"{REPO_URL}/check-runs/{run_id}"
+        check_run["html_url"] = f"https://github.com/cp2k/cp2k/runs/{run_id}"
+        check_run["app"] = {"id": int(os.environ["GITHUB_APP_ID"]), "slug": "cp2k-ci"}
+        check_run["status"] = run_status(check_run)
+        self.check_runs[run_id] = check_run
+        return 201, check_run
+
+    # --------------------------------------------------------------------------
+    def patch_check_run(
+        self, query: Any, body: Dict[str, Any], run_id: str
+    ) -> Tuple[int, Any]:
+        check_run = self.check_runs[int(run_id)]
+        check_run.update(copy.deepcopy(body))
+        check_run["status"] = run_status(check_run)
+        return 200, check_run
+
+    # --------------------------------------------------------------------------
+    def graphql(self, query: Any, body: Dict[str, Any]) -> Tuple[int, Any]:
+        app = {"databaseId": int(os.environ["GITHUB_APP_ID"]), "slug": "cp2k-ci"}
+        nodes = []
+        for pr in self.pull_requests.values():
+            runs = self.latest_check_runs(pr.head_sha)
+            run_nodes = [
+                {
+                    "databaseId": r["id"],
+                    "name": r["name"],
+                    "status": r["status"].upper(),
+                    "startedAt": r.get("started_at"),
+                    "title": r.get("output", {}).get("title"),
+                    "summary": r.get("output", {}).get("summary"),
+                }
+                for r in runs
+            ]
+            more: Dict[str, Any] = {"hasNextPage": False}
+            suite = {"app": app, "checkRuns": {"pageInfo": more, "nodes": run_nodes}}
+            suites = {"pageInfo": more, "nodes": [suite]}
+            commit = {"commit": {"checkSuites": suites}}
+            node = {
+                "number": pr.number,
+                "createdAt": pr.created_at,
+                "author": {"login": "octocat"},
+                "headRefOid": pr.head_sha,
+                "baseRefName": "master",
+                "commits": {"nodes": [commit]},
+            }
+            nodes.append(node)
+        page_info = {"hasNextPage": False, "endCursor": None}
+        pull_requests = {"pageInfo": page_info, "nodes": nodes}
+        return 200, {"data": {"repository": {"pullRequests": pull_requests}}}
+
+    # --------------------------------------------------------------------------
+    def get_member(self, query: Any, body: Any) -> Tuple[int, Any]:
+        return 204, None
+
+
+# ======================================================================================
+def run_status(check_run: Dict[str, Any]) -> str:
+    # GitHub completes check runs that come with a conclusion.
+    if check_run.get("conclusion"):
+        return "completed"
+    return str(check_run.get("status") or "queued")
+
+
+# ======================================================================================
+def clone_model(obj: T) -> T:
+    # Copies Kubernetes models orders of magnitude faster than copy.deepcopy().
+    if isinstance(obj, list):
+        return cast(T, [clone_model(v) for v in obj])
+    if isinstance(obj, dict):
+        return cast(T, {k: clone_model(v) for k, v in obj.items()})
+    if hasattr(obj, "openapi_types"):
+        attrs = {k: clone_model(getattr(obj, k)) for k in obj.openapi_types}
+        model_class: Any = type(obj)
+        return cast(
+            T, model_class(local_vars_configuration=MODEL_CONFIGURATION, **attrs)
+        )
+    return obj  # immutable, e.g. str or datetime
+
+
+# ======================================================================================
+class FakeWatch:
+    """Stand-in for kubernetes.watch.Watch that streams the events of a FakeBatchApi."""
+
+    def __init__(self, batch_api: "FakeBatchApi"):
+        self.batch_api = batch_api
+
+    # --------------------------------------------------------------------------
+    def stream(
+        self,
+        func: Any,
+        namespace: str,
+        resource_version: Optional[str] = None,
+        timeout_seconds: int = 300,
+        **kwargs: Any,
+    ) -> Iterator[Dict[str, Any]]:
+        self.batch_api.record_call("WATCH jobs")
+        last_seen = int(resource_version or 0)
+        deadline = monotonic() + timeout_seconds
+        while True:
+            with self.batch_api.changed:
+                events = self.batch_api.events[last_seen:]  # i-th event has version i+1
+                if not events:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return
+                    self.batch_api.changed.wait(remaining)
+                    continue
+            for event_type, job in events:
+                last_seen += 1
+                yield {"type": event_type, "object": clone_model(job)}
+
+
+# ======================================================================================
+class FakeBatchApi(FakeService):
+    """Stand-in for kubernetes.client.BatchV1Api, which keeps jobs in memory."""
+
+    def __init__(self, latency: float):
+        super().__init__(latency)
+        self.jobs: Dict[str, V1Job] = {}
+        self.events: List[Tuple[str, V1Job]] = []
+        self.changed = threading.Condition(self.lock)
+
+    # --------------------------------------------------------------------------
+    def new_watch(self) -> FakeWatch:
+        return FakeWatch(self)
+
+    # --------------------------------------------------------------------------
+    def _emit(self, event_type: str, job: V1Job) -> None:
+        with self.changed:
+            job.metadata.resource_version = str(len(self.events) + 1)
+            self.events.append((event_type, clone_model(job)))
+            self.changed.notify_all()
+
+    # --------------------------------------------------------------------------
+    def list_namespaced_job(self, namespace: str, **kwargs: Any) -> V1JobList:
+        self.record_call("GET jobs")
+        with self.lock:
+            items = [clone_model(job) for job in self.jobs.values()]
+            metadata = V1ListMeta(resource_version=str(len(self.events)))
+            return V1JobList(items=items, metadata=metadata)
+
+    # --------------------------------------------------------------------------
+    def create_namespaced_job(
+        self, namespace: str, body: V1Job, **kwargs: Any
+    ) -> V1Job:
+        self.record_call("POST jobs")
+        with self.lock:
+            job = clone_model(body)
+            job.metadata.creation_timestamp = now()
+            job.status = V1JobStatus(active=1)
+            self.jobs[job.metadata.name] = job
+            self._emit("ADDED", job)
+            return clone_model(job)
+
+    # --------------------------------------------------------------------------
+    def patch_namespaced_job(
+        self, name: str, namespace: str, body: V1Job, **kwargs: Any
+    ) -> V1Job:
+        self.record_call("PATCH job")
+        with self.lock:
+            job = self.get_job(name)
+            job.metadata.annotations.update(body.metadata.annotations)
+            self._emit("MODIFIED", job)
+            return clone_model(job)
+
+    # --------------------------------------------------------------------------
+    def delete_namespaced_job(self, name: str, namespace: str, **kwargs: Any) -> None:
+        self.record_call("DELETE job")
+        with self.lock:
+            job = self.get_job(name)
+            del self.jobs[name]
+            self._emit("DELETED", job)
+
+    # --------------------------------------------------------------------------
+    def get_job(self, name: str) -> V1Job:
+        if name not in self.jobs:
+            raise ApiException(status=404, reason="Not Found")
+        return self.jobs[name]
+
+    # --------------------------------------------------------------------------
+    def complete_job(self, name: str, succeeded: bool = True) -> None:
+        # Simulates the end of a job, not counted as call.
+        with self.lock:
+            job = self.get_job(name)
+            condition_type = "Complete" if succeeded else "Failed"
+            condition = V1JobCondition(type=condition_type, status="True")
+            job.status = V1JobStatus(conditions=[condition])
+            if succeeded:
+                job.status.completion_time = now()
+            self._emit("MODIFIED", job)
+
+
+# ======================================================================================
+@dataclass
+class StoredObject:
+    data: bytes
+    generation: int
+    updated: datetime
+    metadata: Dict[str, str] = field(default_factory=dict)
+
+
+# ======================================================================================
+class FakeStorageClient(FakeService):
+    """Stand-in for google.cloud.storage.Client, which keeps objects in memory.
+
+    Calls within a batch are counted as a single round trip.
+    """
+
+    def __init__(self, latency: float):
+        super().__init__(latency)
+        self.buckets: Dict[str, FakeBucket] = {}
+        self.batched_calls: Counter[str] = Counter()
+        self.local = threading.local()
+
+    # --------------------------------------------------------------------------
+    def get_bucket(self, name: str) -> "FakeBucket":
+        self.record_call("GET bucket")
+        with self.lock:
+            if name not in self.buckets:
+                self.buckets[name] = FakeBucket(self, name)
+            return self.buckets[name]
+
+    # --------------------------------------------------------------------------
+    @contextmanager
+    def batch(self, raise_exception: bool = True) -> Iterator[None]:
+        self.local.in_batch = True
+        try:
+            yield
+        finally:
+            self.local.in_batch = False
+        self.record_call("POST batch")
+
+    # --------------------------------------------------------------------------
+    def in_batch(self) -> bool:
+        return bool(getattr(self.local, "in_batch", False))
+
+    # --------------------------------------------------------------------------
+    def call(self, name: str) -> None:
+        if self.in_batch():
+            with self.lock:
+                self.batched_calls[name] += 1
+        else:
+            self.record_call(name)
+
+
+# ======================================================================================
+class FakeBucket:
+    def __init__(self, client: FakeStorageClient, name: str):
+        self.client = client
+        self.name = name
+        self.objects: Dict[str, StoredObject] = {}
+        self.generations = 0
+
+    # --------------------------------------------------------------------------
+    def blob(self, name: str) -> "FakeBlob":
+        return FakeBlob(self, name)
+
+    # --------------------------------------------------------------------------
+    def get_blob(self, name: str) -> Optional["FakeBlob"]:
+        self.client.call("GET object")
+        blob = FakeBlob(self, name)
+        return blob if blob._load() else None
+
+    # --------------------------------------------------------------------------
+    def list_blobs(
+        self, prefix: str = "", match_glob: str = "*", **kwargs: Any
+    ) -> List["FakeBlob"]:
+        self.client.call("GET objects")
+        with self.client.lock:
+            names = sorted(self.objects)
+        names = [n for n in names if n.startswith(prefix)]
+        blobs = [FakeBlob(self, n) for n in names if fnmatch.fnmatch(n, match_glob)]
+        return [b for b in blobs if b._load()]
+
+    # --------------------------------------------------------------------------
+    def put_object(
+        self, name: str, data: bytes, metadata: Optional[Dict[str, str]] = None
+    ) -> StoredObject:
+        # Also used to simulate uploads by the runners, not counted as call.
+        with self.client.lock:
+            self.generations += 1
+            obj = StoredObject(data, self.generations, now(), dict(metadata or {}))
+            self.objects[name] = obj
+            return obj
+
+
+# ======================================================================================
+class FakeBlob:
+    def __init__(self, bucket: FakeBucket, name: str):
+        self.bucket = bucket
+        self.client = bucket.client
+        self.name = name
+        self.public_url = f"https://storage.googleapis.com/{bucket.name}/{name}"
+        self.generation: Optional[int] = None
+        self.size: Optional[int] = None
+        self.updated: Optional[datetime] = None
+        self.metadata: Optional[Dict[str, str]] = None
+        self.cache_control: Optional[str] = None
+
+    # --------------------------------------------------------------------------
+    def _load(self) -> bool:
+        with self.client.lock:
+            obj = self.bucket.objects.get(self.name)
+            if obj is None:
+                self.generation = None  # Like a failed call within a batch.
+                return False
+            self.generation = obj.generation
+            self.size = len(obj.data)
+            self.updated = obj.updated
+            self.metadata = dict(obj.metadata)
+            return True
+
+    # --------------------------------------------------------------------------
+    def _not_found(self) -> Exception:
+        return NotFound(f"No such object: {self.bucket.name}/{self.name}")  # type: ignore
+
+    # --------------------------------------------------------------------------
+    def _get_object(self) -> StoredObject:
+        with self.client.lock:
+            obj = self.bucket.objects.get(self.name)
+        if obj is None:
+            raise self._not_found()
+        return obj
+
+    # --------------------------------------------------------------------------
+    def exists(self) -> bool:
+        self.client.call("GET object")
+        with self.client.lock:
+            return self.name in self.bucket.objects
+
+    # --------------------------------------------------------------------------
+    def reload(self) -> None:
+        self.client.call("GET object")
+        if not self._load() and not self.client.in_batch():
+            raise self._not_found()
+
+    # --------------------------------------------------------------------------
+    def patch(self) -> None:
+        self.client.call("PATCH object")
+        with self.client.lock:
+            obj = self.bucket.objects.get(self.name)
+            if obj is not None:
+                obj.metadata = dict(self.metadata or {})
+        if not self._load() and not self.client.in_batch():
+            raise self._not_found()
+
+    # --------------------------------------------------------------------------
+    def upload_from_string(
+        self,
+        data: Union[str, bytes],
+        content_type: str = "text/plain",
+        if_generation_match: Optional[int] = None,
+    ) -> None:
+        self.client.call("POST upload")
+        raw = data.encode("utf8") if isinstance(data, str) else data
+        with self.client.lock:
+            obj = self.bucket.objects.get(self.name)
+            generation = obj.generation if obj else 0
+            if if_generation_match is not None and if_generation_match != generation:
+                raise PreconditionFailed(f"Generation mismatch: {self.name}")  # type: ignore
+            self.bucket.put_object(self.name, raw, self.metadata)
+        self._load()
+
+    # --------------------------------------------------------------------------
+    def download_as_bytes(
+        self, start: Optional[int] = None, end: Optional[int] = None
+    ) -> bytes:
+        self.client.call("GET media")
+        obj = self._get_object()
+        self.generation = obj.generation
+        if start is not None and start < 0:
+            return obj.data[start:]  # Suffix range.
+        return obj.data[start or 0 : None if end is None else end + 1]
+
+    # --------------------------------------------------------------------------
+    def open(self, mode: str = "rb", chunk_size: int = 0) -> io.BytesIO:
+        assert mode == "rb"
+        return io.BytesIO(self.download_as_bytes())
+
+    # --------------------------------------------------------------------------
+    def rewrite(self, source: "FakeBlob") -> Tuple[None, int, int]:
+        self.client.call("POST rewrite")
+        obj = source._get_object()
+        self.bucket.put_object(self.name, obj.data, obj.metadata)
+        self._load()
+        return None, len(obj.data), len(obj.data)
+
+    # --------------------------------------------------------------------------
+    def generate_signed_url(self, method: str = "GET", **kwargs: Any) -> str:
+        # Signing happens locally, hence this is not counted as call.
+        return f"{self.public_url}?X-Goog-Signature=fake&method={method}"
+
+
+# EOF
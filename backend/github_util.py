@@ -2,15 +2,26 @@
 
 import os
 import jwt
+import json
 import requests
+import threading
+import traceback
 from time import time, sleep
 from pathlib import Path
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, Iterator, List, Literal, Optional, TypedDict, cast
+from typing import Any, Dict, Iterator, List, Literal, Optional, Set, Tuple
+from typing import TypedDict, cast
 from base64 import b64decode
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+from requests.adapters import HTTPAdapter
 
+import metrics
+import tracing
 from target import Target, TargetName, parse_target_config
 from repository_config import RepositoryConfig, get_repository_config_by_name
+from lru_cache import LruCache
 
 GITHUB_APP_ID = os.environ["GITHUB_APP_ID"]
 GITHUB_APP_KEY = Path(os.environ["GITHUB_APP_KEY"]).read_text()
@@ -20,6 +31,43 @@ HttpMethods = Literal["GET", "POST", "PATCH", "DELETE"]
 
 GITHUB_API_VERSION = "2026-03-10"
 
+# Open pull requests together with our latest check runs of their head commit.
+# The GraphQL App object does not expose its owner, hence we fetch its databaseId.
+# Nested connections can not be paginated alongside the pull requests, hence they
+# only report whether there is more, which is then fetched via the REST API.
+PULL_REQUESTS_WITH_CHECK_RUNS_QUERY = """
+query($owner: String!, $repo: String!, $base: String!, $appId: Int!, $cursor: String) {
+  repository(owner: $owner, name: $repo) {
+    pullRequests(states: OPEN, baseRefName: $base, first: 25, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        createdAt
+        author { login }
+        headRefOid
+        baseRefName
+        commits(last: 1) {
+          nodes {
+            commit {
+              checkSuites(first: 1, filterBy: { appId: $appId }) {
+                pageInfo { hasNextPage }
+                nodes {
+                  app { databaseId slug }
+                  checkRuns(first: 100, filterBy: { checkType: LATEST }) {
+                    pageInfo { hasNextPage }
+                    nodes { databaseId name status startedAt title summary }
+                  }
+                }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
 
 # ======================================================================================
 class PullRequestNumber(int):
@@ -67,6 +115,8 @@ class CheckRun(TypedDict, total=False):
 
 # ======================================================================================
 class GithubApp(TypedDict, total=False):
+    id: int
+    slug: str
     owner: User
 
 
@@ -121,6 +171,7 @@ class Repository(TypedDict, total=False):
 # ======================================================================================
 class CheckSuite(TypedDict, total=False):
     check_runs_url: str
+    pull_requests: List[PullRequest]
 
 
 # ======================================================================================
@@ -163,12 +214,179 @@ def assert_check_run_limits(check_run: CheckRun) -> None:
         assert len(a["description"]) <= 40
 
 
+# Used to fetch the remaining pages of a paginated response concurrently.
+PAGE_FETCHER_WORKERS = 8
+page_fetcher = ThreadPoolExecutor(
+    max_workers=PAGE_FETCHER_WORKERS, thread_name_prefix="github-pages"
+)
+
+# Keep-alive connections to api.github.com, shared by all GithubUtil instances.
+# The pool gets sized by set_http_pool_size() once the number of threads is known.
+http_session = requests.Session()
+
+
+# ======================================================================================
+def set_http_pool_size(num_threads: int) -> None:
+    # Keeps one connection per thread that talks to GitHub, including page fetchers.
+    # Otherwise surplus connections get discarded after each request.
+    pool_maxsize = num_threads + PAGE_FETCHER_WORKERS
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+    http_session.mount("https://", adapter)
+
+
+set_http_pool_size(num_threads=8)
+
+
+# ======================================================================================
+def set_http_session(session: Any) -> None:
+    # Allows to inject a fake GitHub API, e.g. for benchmark.py.
+    global http_session
+    http_session = session
+
+
+# ======================================================================================
+def http_request(
+    method: HttpMethods, url: str, headers: Dict[str, str], body: Any = None
+) -> requests.Response:
+    r = http_session.request(
+        method=method, url=url, headers=headers, json=body, timeout=20
+    )
+    metrics.observe_response("github", r)
+    remaining = r.headers.get("X-RateLimit-Remaining", None)
+    if remaining:
+        metrics.github_rate_limit_remaining.set(int(remaining))
+    if remaining and int(remaining) < 100:
+        print(f"X-RateLimit-Remaining: {remaining}")
+    if r.status_code >= 400:
+        print(f"Got http-status {r.status_code} with body: {r.text}")
+    r.raise_for_status()
+    return r
+
+
+# ======================================================================================
+@dataclass
+class InstallationToken:
+    token: str
+    expires_at: datetime
+
+
+# ======================================================================================
+def create_installation_token(install_id: str) -> InstallationToken:
+    # Create App JWT token.
+    now = int(time())
+    payload = {
+        "iat": now,
+        "exp": now + 540,  # expiration, stay away from 10min limit
+        "iss": GITHUB_APP_ID,
+    }
+    app_token = jwt.encode(payload, GITHUB_APP_KEY, algorithm="RS256")
+    # Setup header for app.
+    headers = {
+        "Authorization": "Bearer " + app_token,
+        "Accept": "application/vnd.github+json",
+        "X-GitHub-Api-Version": GITHUB_API_VERSION,
+    }
+    # Obtain installation access token.
+    url = f"https://api.github.com/app/installations/{install_id}/access_tokens"
+    resp = http_request("POST", url, headers).json()
+    expires_at = datetime.fromisoformat(resp["expires_at"])
+    return InstallationToken(token=str(resp["token"]), expires_at=expires_at)
+
+
+# ======================================================================================
+class InstallationTokenCache:
+    """Shares installation tokens across GithubUtil instances.
+
+    Tokens are valid for one hour. Within the last `refresh_margin` of their lifetime
+    a new token is obtained in the background while the old one is still handed out.
+    Within the last `expiry_margin` the old token is no longer used at all.
+    """
+
+    def __init__(self, refresh_margin: timedelta, expiry_margin: timedelta):
+        self.refresh_margin = refresh_margin
+        self.expiry_margin = expiry_margin
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.tokens: Dict[str, InstallationToken] = {}
+        self.background_refreshes: Set[str] = set()
+
+    # --------------------------------------------------------------------------
+    def get(self, install_id: str) -> str:
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            cached = self.tokens.get(install_id)
+            if cached and now < cached.expires_at - self.expiry_margin:
+                due = now >= cached.expires_at - self.refresh_margin
+                if due and install_id not in self.background_refreshes:
+                    self.background_refreshes.add(install_id)
+                    args = (install_id,)
+                    thread = threading.Thread(target=self._refresh_async, args=args)
+                    thread.daemon = True
+                    thread.start()
+                return cached.token
+        return self.refresh(install_id).token  # Missing or expired, have to wait.
+
+    # --------------------------------------------------------------------------
+    def refresh(self, install_id: str) -> InstallationToken:
+        with self.refresh_lock:  # Avoid a stampede of concurrent refreshes.
+            now = datetime.now(timezone.utc)
+            with self.lock:
+                cached = self.tokens.get(install_id)
+            if cached and now < cached.expires_at - self.refresh_margin:
+                return cached  # Another thread was quicker.
+            new_token = create_installation_token(install_id)
+            with self.lock:
+                self.tokens[install_id] = new_token
+            return new_token
+
+    # --------------------------------------------------------------------------
+    def invalidate(self, install_id: str) -> None:
+        with self.lock:
+            self.tokens.pop(install_id, None)
+
+    # --------------------------------------------------------------------------
+    def _refresh_async(self, install_id: str) -> None:
+        try:
+            self.refresh(install_id)
+        except:
+            print(traceback.format_exc())  # Next call to get() will retry.
+        finally:
+            with self.lock:
+                self.background_refreshes.discard(install_id)
+
+
+installation_tokens = InstallationTokenCache(
+    refresh_margin=timedelta(minutes=10), expiry_margin=timedelta(minutes=2)
+)
+
+
+# ======================================================================================
+@dataclass
+class CachedResponse:
+    etag: str
+    last_modified: str
+    content: bytes
+    links: Dict[str, Dict[str, str]]
+
+    def json(self) -> Any:
+        return json.loads(self.content)  # Parse anew, callers might modify result.
+
+
+# Conditional requests that are answered with 304 do not count against the rate limit.
+# https://docs.github.com/en/rest/using-the-rest-api/best-practices-for-using-the-rest-api#use-conditional-requests-if-appropriate
+response_cache: LruCache[str, CachedResponse] = LruCache(
+    max_size=32 * 1024 * 1024, weigh=lambda r: len(r.content)
+)
+
+# Parsed target configs keyed by repository name and git blob sha of the config file.
+target_configs: LruCache[Tuple[str, str], Dict[TargetName, Target]] = LruCache(64)
+
+
 # ======================================================================================
 class GithubUtil:
     def __init__(self, repo_name: str):
         self.repo_conf = get_repository_config_by_name(repo_name)
         self.repo_url = f"https://api.github.com/repos/cp2k/{repo_name}"
-        self.token = self.get_installation_token()
 
     # --------------------------------------------------------------------------
     def get_head_commit(self, branch: str) -> Commit:
@@ -180,38 +398,31 @@ class GithubUtil:
 
     # --------------------------------------------------------------------------
     def get_targets(self, pr: Optional[PullRequest] = None) -> List[Target]:
+        return list(self.get_targets_by_name(pr).values())
+
+    # --------------------------------------------------------------------------
+    def get_targets_by_name(
+        self, pr: Optional[PullRequest] = None
+    ) -> Dict[TargetName, Target]:
         branch = f"pull/{pr['number']}/merge" if pr else "master"
         resp = self._get(f"/contents/{self.repo_conf.targets_config}?ref={branch}")
-        return parse_target_config(self.repo_conf, b64decode(resp["content"]))
+        key = (self.repo_conf.name, resp["sha"])
+        targets = target_configs.get(key)
+        if targets is None:
+            content = b64decode(resp["content"])
+            targets = {t.name: t for t in parse_target_config(self.repo_conf, content)}
+            target_configs.put(key, targets)
+        return targets
 
     # --------------------------------------------------------------------------
     def get_target_by_name(
         self, target_name: TargetName, pr: Optional[PullRequest] = None
     ) -> Target:
-        matches = [t for t in self.get_targets(pr) if t.name == target_name]
-        assert len(matches) == 1
-        return matches[0]
+        return self.get_targets_by_name(pr)[target_name]
 
     # --------------------------------------------------------------------------
     def get_installation_token(self) -> str:
-        # Create App JWT token.
-        now = int(time())
-        payload = {
-            "iat": now,
-            "exp": now + 540,  # expiration, stay away from 10min limit
-            "iss": GITHUB_APP_ID,
-        }
-        app_token = jwt.encode(payload, GITHUB_APP_KEY, algorithm="RS256")
-        # Setup header for app.
-        headers = {
-            "Authorization": "Bearer " + app_token,
-            "Accept": "application/vnd.github+json",
-            "X-GitHub-Api-Version": GITHUB_API_VERSION,
-        }
-        # Obtain installation access token.
-        url = "https://api.github.com/app/installations/{}/access_tokens"
-        r = self._http_request("POST", url.format(GITHUB_APP_INSTALL_ID), headers)
-        return str(r.json()["token"])
+        return installation_tokens.get(GITHUB_APP_INSTALL_ID)
 
     # --------------------------------------------------------------------------
     def now(self) -> str:
@@ -227,16 +438,7 @@ class GithubUtil:
     ) -> requests.Response:
         if url.startswith("/"):
             url = self.repo_url + url
-        r = requests.request(
-            method=method, url=url, headers=headers, json=body, timeout=20
-        )
-        remaining = r.headers.get("X-RateLimit-Remaining", None)
-        if remaining and int(remaining) < 100:
-            print(f"X-RateLimit-Remaining: {remaining}")
-        if r.status_code >= 400:
-            print(f"Got http-status {r.status_code} with body: {r.text}")
-        r.raise_for_status()
-        return r
+        return http_request(method, url, headers, body)
 
     # --------------------------------------------------------------------------
     def _authenticated_http_request(
@@ -245,37 +447,98 @@ class GithubUtil:
         url: str,
         body: Any = None,
         retries: int = 0,
+        extra_headers: Optional[Dict[str, str]] = None,
     ) -> requests.Response:
-        headers = {
-            "Authorization": "token " + self.token,
-            "Accept": "application/vnd.github+json",
-            "X-GitHub-Api-Version": GITHUB_API_VERSION,
-        }
         # we get occasional 401 errors https://github.com/cp2k/cp2k-ci/issues/45
         for i in range(retries):
             try:
+                headers = self._headers(extra_headers)
                 return self._http_request(method, url, headers, body)
-            except:
+            except Exception as e:
+                if isinstance(e, requests.HTTPError) and e.response.status_code == 401:
+                    installation_tokens.invalidate(GITHUB_APP_INSTALL_ID)
                 print("Sleeping a bit before retrying...")
                 sleep(2)
+        headers = self._headers(extra_headers)
         return self._http_request(method, url, headers, body)  # final attempt
 
+    # --------------------------------------------------------------------------
+    def _headers(self, extra_headers: Optional[Dict[str, str]]) -> Dict[str, str]:
+        headers = {
+            "Authorization": "token " + self.get_installation_token(),
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": GITHUB_API_VERSION,
+        }
+        headers.update(extra_headers or {})
+        return headers
+
+    # --------------------------------------------------------------------------
+    def _cached_get(self, url: str) -> CachedResponse:
+        if url.startswith("/"):
+            url = self.repo_url + url
+        cached = response_cache.peek(url)
+        extra_headers = {}
+        if cached and cached.etag:
+            extra_headers["If-None-Match"] = cached.etag
+        elif cached and cached.last_modified:
+            extra_headers["If-Modified-Since"] = cached.last_modified
+        r = self._authenticated_http_request(
+            "GET", url, retries=5, extra_headers=extra_headers
+        )
+        if cached and r.status_code == 304:
+            response_cache.record(hit=True)
+            return cached
+        response_cache.record(hit=False)
+        fresh = CachedResponse(
+            etag=r.headers.get("ETag", ""),
+            last_modified=r.headers.get("Last-Modified", ""),
+            content=r.content,
+            links=r.links,
+        )
+        if fresh.etag or fresh.last_modified:
+            response_cache.put(url, fresh)
+        return fresh
+
     # --------------------------------------------------------------------------
     def _get(self, url: str) -> Any:
-        r = self._authenticated_http_request("GET", url, retries=5)
+        r = self._cached_get(url)
         if "next" in r.links:
             print("Warning: Found unexpected next link at: " + url)
         return r.json()
 
     # --------------------------------------------------------------------------
-    def _iterate_pages(self, url: str) -> Iterator[Any]:
-        r = self._authenticated_http_request("GET", url, retries=5)
+    def _iterate_pages(self, url: str, concurrent: bool = False) -> Iterator[Any]:
+        r = self._cached_get(url)
         yield r.json()
+        if concurrent and "next" in r.links and "last" in r.links:
+            yield from self._fetch_remaining_pages(r.links)
+            return
         while "next" in r.links:
             url = r.links["next"]["url"]
-            r = self._authenticated_http_request("GET", url, retries=5)
+            r = self._cached_get(url)
             yield r.json()
 
+    # --------------------------------------------------------------------------
+    def _fetch_remaining_pages(self, links: Dict[str, Dict[str, str]]) -> Iterator[Any]:
+        # Once the last page is known all page urls can be derived from the next link.
+        next_url = urlsplit(links["next"]["url"])
+        next_query = parse_qs(next_url.query)
+        first_page = int(next_query["page"][0])
+        last_page = int(parse_qs(urlsplit(links["last"]["url"]).query)["page"][0])
+        futures: List[Future[CachedResponse]] = []
+        for page in range(first_page, last_page + 1):
+            query = urlencode({**next_query, "page": [str(page)]}, doseq=True)
+            url = urlunsplit(next_url._replace(query=query))
+            futures.append(
+                page_fetcher.submit(tracing.propagate(self._cached_get), url)
+            )
+        try:
+            for future in futures:
+                yield future.result().json()
+        finally:
+            for future in futures:
+                future.cancel()  # In case the caller stopped iterating early.
+
     # --------------------------------------------------------------------------
     def _post(self, url: str, body: Any) -> Any:
         return self._authenticated_http_request("POST", url, body).json()
@@ -312,18 +575,84 @@ class GithubUtil:
 
     # --------------------------------------------------------------------------
     def iterate_commits(self, url: str) -> Iterator[Commit]:
-        for page in self._iterate_pages(url):
+        for page in self._iterate_pages(url, concurrent=True):
             yield from page
 
     # --------------------------------------------------------------------------
     def iterate_pr_files(self, pr: PullRequest) -> Iterator[DiffEntry]:
-        for page in self._iterate_pages(pr["url"] + "/files"):
+        url = pr["url"] + "/files?per_page=100"
+        for page in self._iterate_pages(url, concurrent=True):
             yield from page
 
     # --------------------------------------------------------------------------
-    def iterate_pull_requests(self) -> Iterator[PullRequest]:
-        for page in self._iterate_pages("/pulls"):
-            yield from page
+    def iterate_pull_requests_with_check_runs(
+        self, base: str
+    ) -> Iterator[Tuple[PullRequest, List[CheckRun]]]:
+        # Uses a few GraphQL queries instead of one REST request per pull request.
+        # The results are converted into the shape of their REST counterparts.
+        variables: Dict[str, Any] = {"owner": "cp2k", "repo": self.repo_conf.name}
+        variables["base"] = base
+        variables["appId"] = int(GITHUB_APP_ID)
+        while True:
+            data = self._graphql(PULL_REQUESTS_WITH_CHECK_RUNS_QUERY, variables)
+            pull_requests = data["repository"]["pullRequests"]
+            for node in pull_requests["nodes"]:
+                pr: PullRequest = {
+                    "number": PullRequestNumber(node["number"]),
+                    "created_at": node["createdAt"],
+                    "user": {"login": (node["author"] or {}).get("login", "ghost")},
+                    "head": {"sha": CommitSha(node["headRefOid"])},
+                    "base": {"ref": node["baseRefName"]},
+                }
+                check_runs: List[CheckRun] = []
+                truncated = False
+                for commit_node in node["commits"]["nodes"]:
+                    suites = commit_node["commit"]["checkSuites"]
+                    truncated |= suites["pageInfo"]["hasNextPage"]
+                    for suite in suites["nodes"]:
+                        truncated |= suite["checkRuns"]["pageInfo"]["hasNextPage"]
+                        app: GithubApp = {
+                            "id": suite["app"]["databaseId"],
+                            "slug": suite["app"]["slug"],
+                        }
+                        for run in suite["checkRuns"]["nodes"]:
+                            run_id = run["databaseId"]
+                            check_run: CheckRun = {
+                                "app": app,
+                                "name": run["name"],
+                                "url": f"{self.repo_url}/check-runs/{run_id}",
+                                "head_sha": pr["head"]["sha"],
+                                "status": run["status"].lower(),
+                                "output": {
+                                    "title": run["title"] or "",
+                                    "summary": run["summary"] or "",
+                                },
+                            }
+                            if run["startedAt"]:
+                                check_run["started_at"] = run["startedAt"]
+                            check_runs.append(check_run)
+                if truncated:
+                    print(f"Listing all check runs of pull request {pr['number']}.")
+                    sha = pr["head"]["sha"]
+                    url = f"/commits/{sha}/check-runs?app_id={GITHUB_APP_ID}"
+                    url += "&filter=latest&per_page=100"
+                    check_runs = list(self.iterate_check_runs(url))
+                yield pr, check_runs
+            if not pull_requests["pageInfo"]["hasNextPage"]:
+                break
+            variables["cursor"] = pull_requests["pageInfo"]["endCursor"]
+
+    # --------------------------------------------------------------------------
+    def is_own_app(self, app: GithubApp) -> bool:
+        return app.get("id") == int(GITHUB_APP_ID)
+
+    # --------------------------------------------------------------------------
+    def _graphql(self, query: str, variables: Dict[str, Any]) -> Any:
+        body = {"query": query, "variables": variables}
+        resp = self._post("https://api.github.com/graphql", body)
+        if resp.get("errors"):
+            raise Exception(f"GraphQL query failed: {resp['errors']}")
+        return resp["data"]
 
     # --------------------------------------------------------------------------
     def clear_reactions(self, url: str) -> None:
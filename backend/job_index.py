@@ -0,0 +1,189 @@
+# author: Ole Schuett
+
+import threading
+import traceback
+from time import sleep
+from collections import defaultdict
+from typing import Dict, List, Literal, Optional, Set, Tuple, TypeVar, get_args
+
+from kubernetes.client.rest import ApiException
+from kubernetes.client.models.v1_job import V1Job
+
+from kubernetes_util import KubernetesUtil
+
+JobState = Literal["waiting", "running", "finished"]
+JOB_STATES: Tuple[JobState, ...] = get_args(JobState)
+
+K = TypeVar("K")
+
+
+# ======================================================================================
+def job_is_active(job: V1Job) -> bool:
+    # https://kubernetes.io/docs/reference/generated/kubernetes-api/v1.25/#jobstatus-v1-batch
+    conditions = [c.type for c in job.status.conditions or []]
+    return "Complete" not in conditions and "Failed" not in conditions
+
+
+# ======================================================================================
+def job_state(job: V1Job) -> JobState:
+    if not job_is_active(job):
+        return "finished"
+    if "cp2kci-started" not in job.metadata.annotations:
+        return "waiting"  # The runner has not uploaded anything yet.
+    return "running"
+
+
+# ======================================================================================
+def discard_from_index(index: Dict[K, Set[str]], key: K, name: str) -> None:
+    index[key].discard(name)
+    if not index[key]:
+        del index[key]
+
+
+# ======================================================================================
+class JobIndex:
+    """In-memory index of jobs, kept up-to-date by a long-lived Kubernetes watch."""
+
+    def __init__(self, kubeutil: KubernetesUtil, selector: str):
+        self.kubeutil = kubeutil
+        self.selector = selector
+        self.lock = threading.Lock()
+        self.resource_version: Optional[str] = None
+        self.jobs: Dict[str, V1Job] = {}
+        self.by_pr: Dict[int, Set[str]] = defaultdict(set)
+        self.by_target: Dict[str, Set[str]] = defaultdict(set)
+        self.by_state: Dict[JobState, Set[str]] = defaultdict(set)
+        self.keys: Dict[str, Tuple[Optional[int], Optional[str], JobState]] = {}
+        self.changed: Set[str] = set()
+
+    # --------------------------------------------------------------------------
+    def start(self) -> None:
+        self.resync()
+        thread = threading.Thread(target=self._watch_loop, name="job-index-watch")
+        thread.daemon = True
+        thread.start()
+
+    # --------------------------------------------------------------------------
+    def resync(self) -> None:
+        job_list = self.kubeutil.list_jobs(self.selector)
+        with self.lock:
+            for name in list(self.jobs):
+                self._remove(name)
+            for job in job_list.items:
+                self._add(job)
+            self.resource_version = job_list.metadata.resource_version
+        print(f"Indexed {len(job_list.items)} jobs.")
+
+    # --------------------------------------------------------------------------
+    def _watch_loop(self) -> None:
+        while True:
+            try:
+                for event_type, job in self.kubeutil.watch_jobs(
+                    self.selector, self.resource_version
+                ):
+                    with self.lock:
+                        if event_type in ("ADDED", "MODIFIED"):
+                            self._add(job)
+                        elif event_type == "DELETED":
+                            self._remove(job.metadata.name)
+                        self.resource_version = job.metadata.resource_version
+            except ApiException as e:
+                if e.status == 410:
+                    print("Job watch expired, re-listing jobs.")
+                    self.resync()
+                else:
+                    print(traceback.format_exc())
+                    sleep(5)
+            except:
+                print(traceback.format_exc())
+                sleep(5)
+
+    # --------------------------------------------------------------------------
+    def _add(self, job: V1Job) -> None:
+        name = job.metadata.name
+        self._remove(name)
+        annotations = job.metadata.annotations or {}
+        pr_number = annotations.get("cp2kci-pull-request-number")
+        pr_key = int(pr_number) if pr_number else None
+        target_key = annotations.get("cp2kci-target")
+        state_key = job_state(job)
+        self.jobs[name] = job
+        self.keys[name] = (pr_key, target_key, state_key)
+        if pr_key is not None:
+            self.by_pr[pr_key].add(name)
+        if target_key is not None:
+            self.by_target[target_key].add(name)
+        self.by_state[state_key].add(name)
+        self.changed.add(name)
+
+    # --------------------------------------------------------------------------
+    def _remove(self, name: str) -> None:
+        self.changed.discard(name)
+        if name not in self.jobs:
+            return
+        del self.jobs[name]
+        pr_key, target_key, state_key = self.keys.pop(name)
+        if pr_key is not None:
+            discard_from_index(self.by_pr, pr_key, name)
+        if target_key is not None:
+            discard_from_index(self.by_target, target_key, name)
+        discard_from_index(self.by_state, state_key, name)
+
+    # --------------------------------------------------------------------------
+    def add(self, job: V1Job) -> None:
+        # Makes a freshly created job visible before the watch reports it.
+        with self.lock:
+            self._add(job)
+
+    # --------------------------------------------------------------------------
+    def delete_job(self, job_name: str) -> None:
+        try:
+            self.kubeutil.delete_job(job_name)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            print(f"Job {job_name} was already deleted.")  # e.g. by a concurrent cancel
+        with self.lock:
+            self._remove(job_name)
+
+    # --------------------------------------------------------------------------
+    def list_jobs(self, state: Optional[JobState] = None) -> List[V1Job]:
+        with self.lock:
+            if state:
+                return [self.jobs[n] for n in self.by_state.get(state, ())]
+            return list(self.jobs.values())
+
+    # --------------------------------------------------------------------------
+    def list_pr_jobs(self, pr_number: int) -> List[V1Job]:
+        with self.lock:
+            return [self.jobs[n] for n in self.by_pr.get(pr_number, ())]
+
+    # --------------------------------------------------------------------------
+    def list_target_jobs(self, target_name: str) -> List[V1Job]:
+        with self.lock:
+            return [self.jobs[n] for n in self.by_target.get(target_name, ())]
+
+    # --------------------------------------------------------------------------
+    def count_jobs(self) -> Dict[JobState, int]:
+        # Includes empty states, so that their metrics drop back to zero.
+        with self.lock:
+            return {s: len(self.by_state.get(s, ())) for s in JOB_STATES}
+
+    # --------------------------------------------------------------------------
+    def pop_changed_jobs(self) -> List[V1Job]:
+        with self.lock:
+            changed_jobs = [self.jobs[n] for n in self.changed]
+            self.changed.clear()
+            return changed_jobs
+
+    # --------------------------------------------------------------------------
+    def mark_changed(self, job_name: Optional[str] = None) -> None:
+        # Without a job_name all jobs get marked.
+        with self.lock:
+            if job_name is None:
+                self.changed.update(self.jobs)
+            elif job_name in self.jobs:
+                self.changed.add(job_name)
+
+
+# EOF
@@ -1,17 +1,25 @@
 # author: Ole Schuett
 
 
+import threading
 from uuid import uuid4
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, Optional, cast
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, cast
 
+import metrics
+import tracing
 from target import Target, TargetName
+from storage_util import StorageUtil
 
 import kubernetes.config
 import kubernetes.client
+import kubernetes.watch
 from kubernetes.client.models.v1_resource_requirements import V1ResourceRequirements
 from kubernetes.client.models.v1_affinity import V1Affinity
 from kubernetes.client.models.v1_job_list import V1JobList
+from kubernetes.client.models.v1_job import V1Job
 
 import google.auth.transport.requests
 import google.auth.compute_engine
@@ -22,65 +30,155 @@ import google.auth.compute_engine
 POD_RUNTIME_LIMIT_SECONDS = 3 * 60 * 60
 JOB_LIFETIME_LIMIT_SECONDS = 12 * 60 * 60
 
+JOBS_ENDPOINT = "/apis/batch/v1/namespaces/:namespace/jobs"
 
+
+# ======================================================================================
+@dataclass
+class RunUploadUrls:
+    report: str
+    report_resumable: str  # Starts a session for appending to the report.
+    artifacts: str
+
+
+# ======================================================================================
 class KubernetesUtil:
     def __init__(
         self,
         output_bucket: Any,
+        storage: StorageUtil,
         image_base: str,
         namespace: str = "default",
+        batch_api: Any = None,
+        watch_factory: Optional[Callable[[], Any]] = None,
+        signing_credentials: Any = None,
     ):
-        try:
-            kubernetes.config.load_kube_config()
-        except Exception:
-            kubernetes.config.load_incluster_config()
+        # The optional arguments allow to inject fakes, e.g. for benchmark.py.
+        if batch_api is None:
+            try:
+                kubernetes.config.load_kube_config()
+            except Exception:
+                kubernetes.config.load_incluster_config()
+            batch_api = kubernetes.client.BatchV1Api()
         self.timeout = 3  # seconds
         self.output_bucket = output_bucket
+        self.storage = storage
         self.image_base = image_base
         self.namespace = namespace
         self.api = kubernetes.client
-        self.batch_api = kubernetes.client.BatchV1Api()
+        self.batch_api: kubernetes.client.BatchV1Api = batch_api
+        self.watch_factory = watch_factory or kubernetes.watch.Watch
+        self.signing_lock = threading.Lock()
+        self.signing_credentials = signing_credentials
+        self.signing_credentials_expiry = datetime.min.replace(tzinfo=timezone.utc)
+        if signing_credentials:
+            self.signing_credentials_expiry = datetime.max.replace(tzinfo=timezone.utc)
+        self.signing_executor = ThreadPoolExecutor(8, thread_name_prefix="signing")
+
+    # --------------------------------------------------------------------------
+    def get_signing_credentials(self) -> Any:
+        # Refreshing credentials is expensive, hence we reuse them until near expiry.
+        with self.signing_lock:
+            now = datetime.now(timezone.utc)
+            if self.signing_credentials and now < self.signing_credentials_expiry:
+                return self.signing_credentials
+            credentials, _ = google.auth.default()
+            auth_request = google.auth.transport.requests.Request()
+            credentials.refresh(auth_request)  # type: ignore
+            self.signing_credentials = google.auth.compute_engine.IDTokenCredentials(
+                request=auth_request,
+                target_audience="",
+                service_account_email="cp2kci-backend@cp2k-org-project.iam.gserviceaccount.com",
+            )  # type: ignore
+            expiry = getattr(credentials, "expiry", None)  # naive datetime in UTC
+            if expiry:
+                expiry = expiry.replace(tzinfo=timezone.utc) - timedelta(minutes=5)
+            self.signing_credentials_expiry = expiry or now + timedelta(minutes=30)
+            return self.signing_credentials
 
     # --------------------------------------------------------------------------
     def get_upload_url(
-        self, path: str, content_type: str = "text/plain;charset=utf-8"
+        self,
+        path: str,
+        content_type: str = "text/plain;charset=utf-8",
+        method: str = "PUT",
     ) -> str:
-        # Get credentials.
-        credentials, _ = google.auth.default()
-        auth_request = google.auth.transport.requests.Request()
-        credentials.refresh(auth_request)  # type: ignore
-        signing_credentials = google.auth.compute_engine.IDTokenCredentials(
-            request=auth_request,
-            target_audience="",
-            service_account_email="cp2kci-backend@cp2k-org-project.iam.gserviceaccount.com",
-        )  # type: ignore
-        # Sign the URL.
         blob = self.output_bucket.blob(path)
         upload_url = blob.generate_signed_url(
             expiration=datetime.now(timezone.utc) + timedelta(hours=12),
-            method="PUT",
+            method=method,
             content_type=content_type,
-            credentials=signing_credentials,
+            credentials=self.get_signing_credentials(),
             version="v4",
         )
         return str(upload_url)
 
+    # --------------------------------------------------------------------------
+    def get_upload_urls(self, uploads: List[Tuple[str, str, str]]) -> List[str]:
+        # Signs many (path, content_type, method) triples concurrently.
+        with tracing.span("sign_upload_urls", num_urls=len(uploads)):
+            self.get_signing_credentials()  # Refresh only once.
+            futures = [
+                self.signing_executor.submit(tracing.propagate(self.get_upload_url), *u)
+                for u in uploads
+            ]
+            return [f.result() for f in futures]
+
+    # --------------------------------------------------------------------------
+    def sign_run_upload_urls(self, job_names: List[str]) -> Dict[str, RunUploadUrls]:
+        # Signs the report and artifacts upload urls for many jobs in one go.
+        uploads: List[Tuple[str, str, str]] = []
+        for job_name in job_names:
+            report_path = f"{job_name}_report.txt"
+            uploads.append((report_path, "text/plain;charset=utf-8", "PUT"))
+            uploads.append((report_path, "text/plain;charset=utf-8", "RESUMABLE"))
+            uploads.append((f"{job_name}_artifacts.zip", "application/zip", "PUT"))
+        urls = self.get_upload_urls(uploads)
+        return {
+            job_name: RunUploadUrls(*urls[3 * i : 3 * i + 3])
+            for i, job_name in enumerate(job_names)
+        }
+
+    # --------------------------------------------------------------------------
+    def new_job_name(self, target: Target) -> str:
+        short_uuid = str(uuid4())[:8]
+        return f"run-{target.name}-{short_uuid}"
+
     # --------------------------------------------------------------------------
     def list_jobs(self, selector: str) -> V1JobList:
-        job_list = self.batch_api.list_namespaced_job(
-            self.namespace, label_selector=selector, _request_timeout=self.timeout
-        )  # type: ignore
+        with metrics.observe_call("kubernetes", "GET", JOBS_ENDPOINT):
+            job_list = self.batch_api.list_namespaced_job(
+                self.namespace, label_selector=selector, _request_timeout=self.timeout
+            )  # type: ignore
         return cast(V1JobList, job_list)
 
+    # --------------------------------------------------------------------------
+    def watch_jobs(
+        self, selector: str, resource_version: Optional[str]
+    ) -> Iterator[Tuple[str, V1Job]]:
+        # The server closes the watch after timeout_seconds, callers simply resume.
+        watch = self.watch_factory()
+        for event in watch.stream(
+            self.batch_api.list_namespaced_job,
+            self.namespace,
+            label_selector=selector,
+            resource_version=resource_version,
+            allow_watch_bookmarks=True,
+            timeout_seconds=300,
+            _request_timeout=330,
+        ):
+            yield event["type"], event["object"]
+
     # --------------------------------------------------------------------------
     def delete_job(self, job_name: str) -> None:
         print("deleting job: " + job_name)
-        self.batch_api.delete_namespaced_job(
-            job_name,
-            self.namespace,
-            propagation_policy="Background",
-            _request_timeout=self.timeout,
-        )  # type: ignore
+        with metrics.observe_call("kubernetes", "DELETE", JOBS_ENDPOINT + "/:name"):
+            self.batch_api.delete_namespaced_job(
+                job_name,
+                self.namespace,
+                propagation_policy="Background",
+                _request_timeout=self.timeout,
+            )  # type: ignore
 
     # --------------------------------------------------------------------------
     def patch_job_annotations(
@@ -89,15 +187,14 @@ class KubernetesUtil:
         new_annotations["cp2kci-updated"] = self.now()
         new_job_metadata = self.api.V1ObjectMeta(annotations=new_annotations)
         new_job = self.api.V1Job(metadata=new_job_metadata)
-        self.batch_api.patch_namespaced_job(
-            job_name, self.namespace, new_job, _request_timeout=self.timeout
-        )  # type: ignore
+        with metrics.observe_call("kubernetes", "PATCH", JOBS_ENDPOINT + "/:name"):
+            self.batch_api.patch_namespaced_job(
+                job_name, self.namespace, new_job, _request_timeout=self.timeout
+            )  # type: ignore
 
         # also update annotations of report_blob
-        report_blob = self.output_bucket.blob(new_annotations["cp2kci-report-path"])
-        if report_blob.exists():
-            report_blob.metadata = new_annotations
-            report_blob.patch()
+        report_path = new_annotations["cp2kci-report-path"]
+        self.storage.queue_metadata_patch(report_path, new_annotations)
 
     # --------------------------------------------------------------------------
     def now(self) -> str:
@@ -131,11 +228,15 @@ class KubernetesUtil:
         job_annotations: Dict[str, str],
         use_cache: bool = True,
         priority: Optional[str] = None,
-    ) -> None:
+        job_name: Optional[str] = None,
+        upload_urls: Optional[RunUploadUrls] = None,
+    ) -> V1Job:
         print(f"Submitting run for target: {target.name}.")
 
-        short_uuid = str(uuid4())[:8]
-        job_name = f"run-{target.name}-{short_uuid}"
+        if not job_name:
+            job_name = self.new_job_name(target)
+        if not upload_urls:
+            upload_urls = self.sign_run_upload_urls([job_name])[job_name]
         report_path = f"{job_name}_report.txt"
         artifacts_path = f"{job_name}_artifacts.zip"
         report_blob = self.output_bucket.blob(report_path)
@@ -144,6 +245,8 @@ class KubernetesUtil:
         # amend job annotations
         job_annotations["cp2kci-target"] = target.name
         job_annotations["cp2kci-repository"] = target.repository
+        job_annotations["cp2kci-nodepools"] = " ".join(target.nodepools)
+        job_annotations["cp2kci-git-ref"] = git_ref
         job_annotations["cp2kci-report-path"] = report_path
         job_annotations["cp2kci-report-url"] = report_blob.public_url
         job_annotations["cp2kci-artifacts-path"] = artifacts_path
@@ -160,10 +263,9 @@ class KubernetesUtil:
         env_vars["GIT_BRANCH"] = git_branch
         env_vars["GIT_REF"] = git_ref
         env_vars["GIT_REPO"] = target.repository
-        env_vars["REPORT_UPLOAD_URL"] = self.get_upload_url(report_path)
-        env_vars["ARTIFACTS_UPLOAD_URL"] = self.get_upload_url(
-            artifacts_path, content_type="application/zip"
-        )
+        env_vars["REPORT_UPLOAD_URL"] = upload_urls.report
+        env_vars["REPORT_RESUMABLE_URL"] = upload_urls.report_resumable
+        env_vars["ARTIFACTS_UPLOAD_URL"] = upload_urls.artifacts
 
         if target.runner == "remote":
             env_vars["REMOTE_HOST"] = target.remote_host
@@ -275,9 +377,11 @@ class KubernetesUtil:
             active_deadline_seconds=JOB_LIFETIME_LIMIT_SECONDS,
         )
         job = self.api.V1Job(spec=job_spec, metadata=job_metadata)
-        self.batch_api.create_namespaced_job(
-            self.namespace, body=job, _request_timeout=self.timeout
-        )  # type: ignore
+        with metrics.observe_call("kubernetes", "POST", JOBS_ENDPOINT):
+            new_job = self.batch_api.create_namespaced_job(
+                self.namespace, body=job, _request_timeout=self.timeout
+            )  # type: ignore
+        return cast(V1Job, new_job)
 
 
 # EOF
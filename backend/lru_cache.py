@@ -0,0 +1,80 @@
+# author: Ole Schuett
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+# ======================================================================================
+class LruCache(Generic[K, V]):
+    """Thread-safe least-recently-used cache.
+
+    The capacity is given in units of `weigh(value)`, which defaults to one per entry.
+    """
+
+    def __init__(self, max_size: int, weigh: Callable[[V], int] = lambda v: 1):
+        self.max_size = max_size
+        self.weigh = weigh
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[K, V] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    # --------------------------------------------------------------------------
+    def get(self, key: K) -> Optional[V]:
+        value = self.peek(key)
+        self.record(hit=value is not None)
+        return value
+
+    # --------------------------------------------------------------------------
+    def peek(self, key: K) -> Optional[V]:
+        # Like get(), but leaves the hit/miss counters alone.
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    # --------------------------------------------------------------------------
+    def put(self, key: K, value: V) -> None:
+        with self.lock:
+            self._discard(key)
+            self.entries[key] = value
+            self.size += self.weigh(value)
+            while self.size > self.max_size and len(self.entries) > 1:
+                self._discard(next(iter(self.entries)))
+
+    # --------------------------------------------------------------------------
+    def discard(self, key: K) -> None:
+        with self.lock:
+            self._discard(key)
+
+    # --------------------------------------------------------------------------
+    def _discard(self, key: K) -> None:
+        if key in self.entries:
+            self.size -= self.weigh(self.entries.pop(key))
+
+    # --------------------------------------------------------------------------
+    def record(self, hit: bool) -> None:
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    # --------------------------------------------------------------------------
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "size": self.size,
+            }
+
+
+# EOF
@@ -0,0 +1,120 @@
+# author: Ole Schuett
+
+import re
+from time import time
+from contextlib import contextmanager
+from typing import Any, Iterator
+from urllib.parse import urlsplit
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+import tracing
+
+METRICS_PORT = 9090
+
+# Most calls are quick, but GitHub and GCS occasionally take many seconds.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# ======================================================================================
+tick_duration = Histogram(
+    "cp2kci_tick_duration_seconds",
+    "Duration of the main loop's ticks.",
+    buckets=LATENCY_BUCKETS,
+)
+last_tick_time = time()
+tick_lag = Gauge(
+    "cp2kci_tick_lag_seconds",
+    "Time since the last tick completed, should stay below ten seconds.",
+)
+tick_lag.set_function(lambda: time() - last_tick_time)
+
+jobs = Gauge("cp2kci_jobs", "Number of known jobs per state.", ["state"])
+
+pubsub_messages_in_flight = Gauge(
+    "cp2kci_pubsub_messages_in_flight",
+    "Pub/Sub messages that were received, but not yet acknowledged.",
+)
+rpc_latency = Histogram(
+    "cp2kci_rpc_latency_seconds",
+    "Time from receiving an RPC until it was processed, including queueing.",
+    ["rpc"],
+    buckets=LATENCY_BUCKETS,
+)
+
+api_calls = Histogram(
+    "cp2kci_api_call_duration_seconds",
+    "Latency of calls to external services per endpoint.",
+    ["service", "method", "endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+api_errors = Counter(
+    "cp2kci_api_call_errors_total",
+    "Failed calls to external services per endpoint.",
+    ["service", "method", "endpoint"],
+)
+github_rate_limit_remaining = Gauge(
+    "cp2kci_github_rate_limit_remaining",
+    "Last seen value of GitHub's X-RateLimit-Remaining header.",
+)
+
+
+# ======================================================================================
+def start_metrics_server() -> None:
+    start_http_server(METRICS_PORT)
+    print(f"Serving metrics on port {METRICS_PORT}.")
+
+
+# ======================================================================================
+def record_tick_completed() -> None:
+    global last_tick_time
+    last_tick_time = time()
+
+
+# ======================================================================================
+@contextmanager
+def observe_call(service: str, method: str, endpoint: str) -> Iterator[None]:
+    start = time()
+    try:
+        with tracing.span(service, method=method, endpoint=endpoint):
+            yield
+    except:
+        api_errors.labels(service, method, endpoint).inc()
+        raise
+    finally:
+        api_calls.labels(service, method, endpoint).observe(time() - start)
+
+
+# ======================================================================================
+def observe_response(service: str, response: Any) -> None:
+    # Records a response from the requests library, works also as response hook.
+    method = response.request.method
+    endpoint = normalize_endpoint(response.request.url)
+    duration = response.elapsed.total_seconds()
+    api_calls.labels(service, method, endpoint).observe(duration)
+    error = None
+    if response.status_code >= 400:
+        api_errors.labels(service, method, endpoint).inc()
+        error = f"HTTP {response.status_code}"
+    attributes = dict(method=method, endpoint=endpoint, status=response.status_code)
+    tracing.record(service, duration, error, **attributes)
+
+
+# ======================================================================================
+def observe_gcs_response(response: Any, *args: Any, **kwargs: Any) -> None:
+    observe_response("gcs", response)
+
+
+# ======================================================================================
+def normalize_endpoint(url: str) -> str:
+    # Replaces ids, shas, names, and paths to keep the number of label values small.
+    path = urlsplit(url).path
+    path = re.sub(r"/o/[^/]+", "/o/:object", path)
+    path = re.sub(r"/contents/.*", "/contents/:path", path)
+    path = re.sub(r"/members/[^/]+", "/members/:login", path)
+    path = re.sub(r"/teams/[^/]+", "/teams/:slug", path)
+    path = re.sub(r"/[0-9a-f]{40}(?=/|$)", "/:sha", path)
+    path = re.sub(r"/[0-9]+(?=/|$)", "/:id", path)
+    return path
+
+
+# EOF
@@ -0,0 +1,107 @@
+# author: Ole Schuett
+
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import tracing
+from lru_cache import LruCache
+
+BATCH_SIZE = 100  # Maximum number of calls per batch request recommended by GCS.
+
+
+# ======================================================================================
+@dataclass
+class BlobState:
+    generation: int
+    size: int
+    updated: datetime
+    metadata: Dict[str, str]
+
+
+# ======================================================================================
+class StorageUtil:
+    """Caches the state of blobs between ticks and sends metadata calls in batches.
+
+    Only existing blobs are cached, because a missing blob might get uploaded any time.
+    """
+
+    def __init__(self, client: Any, bucket: Any):
+        self.client = client
+        self.bucket = bucket
+        self.states: LruCache[str, BlobState] = LruCache(4096)
+        self.lock = threading.Lock()
+        self.pending_patches: Dict[str, Dict[str, str]] = {}
+
+    # --------------------------------------------------------------------------
+    def refresh(self, paths: List[str]) -> None:
+        # Reloads the given blobs using one round trip per BATCH_SIZE blobs.
+        unique_paths = list(dict.fromkeys(paths))
+        with tracing.span("storage.refresh", num_blobs=len(unique_paths)):
+            for i in range(0, len(unique_paths), BATCH_SIZE):
+                batch_paths = unique_paths[i : i + BATCH_SIZE]
+                blobs = [self.bucket.blob(p) for p in batch_paths]
+                with self.client.batch(raise_exception=False):
+                    for blob in blobs:
+                        blob.reload()
+                for blob in blobs:
+                    self._update(blob)
+
+    # --------------------------------------------------------------------------
+    def lookup(self, path: str) -> Optional[BlobState]:
+        state = self.states.get(path)
+        if state is None:
+            self.refresh([path])
+            state = self.states.peek(path)
+        return state
+
+    # --------------------------------------------------------------------------
+    def queue_metadata_patch(self, path: str, metadata: Dict[str, str]) -> None:
+        # The patch is sent by the next flush(), later patches replace earlier ones.
+        with self.lock:
+            self.pending_patches[path] = dict(metadata)
+
+    # --------------------------------------------------------------------------
+    def flush(self) -> None:
+        with self.lock:
+            patches, self.pending_patches = self.pending_patches, {}
+        items = list(patches.items())
+        try:
+            with tracing.span("storage.flush", num_blobs=len(items)):
+                self._send_patches(items)
+        except:
+            with self.lock:  # Retry with next flush unless superseded in the meantime.
+                for path, metadata in patches.items():
+                    self.pending_patches.setdefault(path, metadata)
+            raise
+
+    # --------------------------------------------------------------------------
+    def _send_patches(self, items: List[Tuple[str, Dict[str, str]]]) -> None:
+        for i in range(0, len(items), BATCH_SIZE):
+            blobs = []
+            with self.client.batch(raise_exception=False):
+                for path, metadata in items[i : i + BATCH_SIZE]:
+                    blob = self.bucket.blob(path)
+                    blob.metadata = metadata
+                    blob.patch()  # Fails harmlessly for missing blobs.
+                    blobs.append(blob)
+            for blob in blobs:
+                self._update(blob)
+
+    # --------------------------------------------------------------------------
+    def _update(self, blob: Any) -> None:
+        # For failed calls the batch leaves the error response in the blob's properties.
+        if blob.generation is None:
+            self.states.discard(blob.name)
+            return
+        state = BlobState(
+            generation=blob.generation,
+            size=blob.size or 0,
+            updated=blob.updated,
+            metadata=blob.metadata or {},
+        )
+        self.states.put(blob.name, state)
+
+
+# EOF
@@ -0,0 +1,198 @@
+# author: Ole Schuett
+
+import os
+import sys
+import json
+import threading
+import contextvars
+from uuid import uuid4
+from time import monotonic, sleep
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from types import FrameType
+from typing import Any, Callable, Dict, Iterator, Optional, TypeVar
+
+# Spans shorter than this are not logged to keep the log volume bearable.
+TRACING_MIN_DURATION = float(os.environ.get("TRACING_MIN_DURATION_MS", "50")) / 1e3
+
+# Ticks and RPCs that take longer than this get their profile dumped.
+PROFILE_TICK_THRESHOLD = float(os.environ.get("PROFILE_TICK_THRESHOLD", "10"))
+PROFILE_RPC_THRESHOLD = float(os.environ.get("PROFILE_RPC_THRESHOLD", "60"))
+PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL_MS", "50")) / 1e3
+PROFILE_MAX_STACKS = 20
+
+correlation_id: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "correlation_id", default="-"
+)
+current_span_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "current_span_id", default=None
+)
+
+R = TypeVar("R")
+
+
+# ======================================================================================
+def new_correlation_id(prefix: str) -> str:
+    return f"{prefix}/{uuid4().hex[:8]}"
+
+
+# ======================================================================================
+@contextmanager
+def correlated(cid: str) -> Iterator[None]:
+    token = correlation_id.set(cid)
+    try:
+        yield
+    finally:
+        correlation_id.reset(token)
+
+
+# ======================================================================================
+def propagate(func: Callable[..., R]) -> Callable[..., R]:
+    # Carries the caller's correlation id and span over into an executor's thread.
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+
+# ======================================================================================
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[None]:
+    span_id = uuid4().hex[:8]
+    parent_id = current_span_id.get()
+    token = current_span_id.set(span_id)
+    start_time = datetime.now(timezone.utc)
+    start = monotonic()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        current_span_id.reset(token)
+        duration = monotonic() - start
+        emit(name, start_time, duration, error, span_id, parent_id, attributes)
+
+
+# ======================================================================================
+def record(name: str, duration: float, error: Optional[str], **attributes: Any) -> None:
+    # Logs a span that has already ended, e.g. from a response hook.
+    start_time = datetime.now(timezone.utc) - timedelta(seconds=duration)
+    span_id = uuid4().hex[:8]
+    parent_id = current_span_id.get()
+    emit(name, start_time, duration, error, span_id, parent_id, attributes)
+
+
+# ======================================================================================
+def emit(
+    name: str,
+    start_time: datetime,
+    duration: float,
+    error: Optional[str],
+    span_id: str,
+    parent_id: Optional[str],
+    attributes: Dict[str, Any],
+) -> None:
+    if duration < TRACING_MIN_DURATION and not error:
+        return
+    entry = {
+        "span": name,
+        "correlation_id": correlation_id.get(),
+        "span_id": span_id,
+        "parent_id": parent_id,
+        "start": start_time.isoformat(),
+        "duration_ms": round(duration * 1e3, 1),
+        "thread": threading.current_thread().name,
+        "error": error,
+        **attributes,
+    }
+    print(json.dumps(entry, default=str))
+
+
+# ======================================================================================
+class SamplingProfiler:
+    """Periodically samples the stacks of threads that are currently being watched.
+
+    Only threads within a profiled() block are sampled, hence it's idle otherwise.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.samples: Dict[int, Counter[str]] = {}
+        self.thread: Optional[threading.Thread] = None
+
+    # --------------------------------------------------------------------------
+    def watch(self, thread_id: int) -> bool:
+        with self.lock:
+            if thread_id in self.samples:
+                return False  # Already watched by an outer profiled() block.
+            self.samples[thread_id] = Counter()
+            if not self.thread:
+                self.thread = threading.Thread(
+                    target=self._sample_loop, name="profiler", daemon=True
+                )
+                self.thread.start()
+            return True
+
+    # --------------------------------------------------------------------------
+    def unwatch(self, thread_id: int) -> Counter[str]:
+        with self.lock:
+            return self.samples.pop(thread_id)
+
+    # --------------------------------------------------------------------------
+    def _sample_loop(self) -> None:
+        while True:
+            sleep(self.interval)
+            with self.lock:
+                thread_ids = list(self.samples)
+            if not thread_ids:
+                continue
+            frames = sys._current_frames()
+            stacks = {t: collapse_stack(frames[t]) for t in thread_ids if t in frames}
+            with self.lock:
+                for thread_id, stack in stacks.items():
+                    if thread_id in self.samples:
+                        self.samples[thread_id][stack] += 1
+
+
+profiler = SamplingProfiler(PROFILER_INTERVAL)
+
+
+# ======================================================================================
+def collapse_stack(frame: Optional[FrameType]) -> str:
+    # Uses the collapsed format of flamegraph.pl, i.e. root first.
+    entries = []
+    while frame:
+        filename = os.path.basename(frame.f_code.co_filename)
+        entries.append(f"{frame.f_code.co_name} ({filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(entries))
+
+
+# ======================================================================================
+@contextmanager
+def profiled(name: str, threshold: float) -> Iterator[None]:
+    # Dumps a profile of the current thread if the block takes longer than threshold.
+    thread_id = threading.get_ident()
+    watching = profiler.watch(thread_id)
+    start = monotonic()
+    try:
+        yield
+    finally:
+        duration = monotonic() - start
+        samples = profiler.unwatch(thread_id) if watching else None
+        if samples is not None and duration > threshold:
+            stacks = dict(samples.most_common(PROFILE_MAX_STACKS))
+            entry = {
+                "profile": name,
+                "correlation_id": correlation_id.get(),
+                "duration_s": round(duration, 1),
+                "interval_ms": PROFILER_INTERVAL * 1e3,
+                "num_samples": sum(samples.values()),
+                "stacks": stacks,
+            }
+            print(json.dumps(entry))
+
+
+# EOF
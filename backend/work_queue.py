@@ -0,0 +1,99 @@
+# author: Ole Schuett
+
+import threading
+import traceback
+import contextvars
+from collections import deque
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Hashable, List, Optional
+
+Task = Callable[[], None]
+
+
+# ======================================================================================
+@dataclass
+class WorkItem:
+    task: Task
+    coalesce_tag: Optional[str]
+    on_done: List[Task] = field(default_factory=list)
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+
+
+# ======================================================================================
+class KeyedWorkQueue:
+    """Runs tasks with the same key one after another, and different keys in parallel.
+
+    A task submitted with a coalesce_tag replaces all tasks with the same key and tag
+    that are still waiting. Their on_done callbacks are run once the replacement
+    finishes. Tasks without a key are run right away without any ordering.
+    Tasks run within a copy of the submitter's context, e.g. its correlation id.
+    """
+
+    def __init__(self, max_workers: int):
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="work-queue")
+        self.lock = threading.Lock()
+        self.lanes: Dict[Hashable, Deque[WorkItem]] = {}
+
+    # --------------------------------------------------------------------------
+    def submit(
+        self,
+        key: Optional[Hashable],
+        task: Task,
+        coalesce_tag: Optional[str] = None,
+        on_done: Optional[Task] = None,
+    ) -> None:
+        item = WorkItem(task=task, coalesce_tag=coalesce_tag)
+        if on_done:
+            item.on_done.append(on_done)
+
+        if key is None:
+            self.executor.submit(self._run, item)
+            return
+
+        with self.lock:
+            lane = self.lanes.get(key)
+            if lane is None:
+                lane = self.lanes[key] = deque()
+                self.executor.submit(self._drain, key)
+            if coalesce_tag:
+                for waiting in [i for i in lane if i.coalesce_tag == coalesce_tag]:
+                    print(f"Coalescing {coalesce_tag} work for {key}.")
+                    lane.remove(waiting)
+                    item.on_done.extend(waiting.on_done)
+            lane.append(item)
+
+    # --------------------------------------------------------------------------
+    def pending(self) -> int:
+        with self.lock:
+            return sum(len(lane) for lane in self.lanes.values())
+
+    # --------------------------------------------------------------------------
+    def _drain(self, key: Hashable) -> None:
+        while True:
+            with self.lock:
+                lane = self.lanes[key]
+                if not lane:
+                    del self.lanes[key]  # Next submit will start a new drain.
+                    return
+                item = lane.popleft()
+            self._run(item)
+
+    # --------------------------------------------------------------------------
+    def _run(self, item: WorkItem) -> None:
+        item.context.run(self._run_in_context, item)
+
+    # --------------------------------------------------------------------------
+    def _run_in_context(self, item: WorkItem) -> None:
+        try:
+            item.task()
+        except:
+            print(traceback.format_exc())
+        for callback in item.on_done:
+            try:
+                callback()
+            except:
+                print(traceback.format_exc())
+
+
+# EOF
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+# author: Ole Schuett
+
+import os
+import re
+import sys
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import statistics
+from time import monotonic, sleep
+from pathlib import Path
+from collections import Counter
+from dataclasses import dataclass
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
+from typing import Callable, Dict, Iterator, List
+
+os.environ.setdefault("GITHUB_WEBHOOK_SECRET", "benchmark")  # read upon import
+
+import frontend
+
+MiB = 1024 * 1024
+COPY_CHUNK_SIZE = 256 * 1024
+
+
+# ======================================================================================
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the artifact browser.")
+    parser.add_argument("--scale", type=float, default=1.0, help="of archive sizes")
+    parser.add_argument("--repeat", type=int, default=5, help="warm runs per request")
+    parser.add_argument("--latency", type=float, default=0, help="per request in ms")
+    parser.add_argument("--workdir", help="keeps generated archives for reuse")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = Path(args.workdir or tmpdir)
+        workdir.mkdir(parents=True, exist_ok=True)
+        archives = {}
+        for shape, generator in ARCHIVE_SHAPES.items():
+            path = workdir / f"{shape}-{args.scale:g}_artifacts.zip"
+            if not path.exists():
+                print(f"Generating {path.name}...", file=sys.stderr)
+                generator(path, args.scale)
+            archives[shape] = path
+
+        server = RangeServer(workdir, latency=args.latency / 1e3)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        frontend.ARTIFACTS_BASE_URL = server.base_url
+
+        print_header()
+        for shape, path in archives.items():
+            archive = path.name.removesuffix("_artifacts.zip")
+            for request in plan_requests(path):
+                cold = measure(server, archive, request, cold=True)
+                warm = [measure(server, archive, request) for _ in range(args.repeat)]
+                print_result(shape, request, "cold", [cold])
+                print_result(shape, request, "warm", warm)
+        server.shutdown()
+
+
+# ======================================================================================
+def log_lines(rng: random.Random, num_bytes: int) -> Iterator[bytes]:
+    # Looks roughly like the output of a regtest run, hence compresses similarly.
+    written = 0
+    while written < num_bytes:
+        lines = []
+        for _ in range(1000):
+            test = f"QS/regtest-{rng.randint(1, 300)}/H2O-{rng.randint(1, 64)}.inp"
+            energy = rng.uniform(-100, 0)
+            timing = rng.uniform(0, 30)
+            lines.append(f"{test:<50} {energy:>20.12f} {timing:8.2f} OK\n")
+        chunk = "".join(lines).encode("utf8")[: num_bytes - written]
+        written += len(chunk)
+        yield chunk
+
+
+# ======================================================================================
+def generate_many_small_files(path: Path, scale: float) -> None:
+    # Like the per-test outputs of a full regtest run.
+    rng = random.Random(42)
+    with ZipFile(path, "w", ZIP_DEFLATED) as zip_file:
+        for i in range(int(20000 * scale)):
+            name = f"regtests/QS/regtest-{i % 300}/H2O-{i}.inp.out"
+            content = b"".join(log_lines(rng, rng.randint(200, 4000)))
+            zip_file.writestr(name, content)
+
+
+# ======================================================================================
+def generate_few_huge_logs(path: Path, scale: float) -> None:
+    # Like the build and test logs of a long toolchain run, one of them uncompressed.
+    rng = random.Random(43)
+    with ZipFile(path, "w") as zip_file:
+        for i, compress_type in enumerate([ZIP_DEFLATED, ZIP_DEFLATED, ZIP_STORED]):
+            info = ZipInfo(f"logs/huge-{i}.log")
+            info.compress_type = compress_type
+            with zip_file.open(info, "w", force_zip64=True) as member:
+                for chunk in log_lines(rng, int(64 * MiB * scale)):
+                    member.write(chunk)
+        zip_file.writestr("summary.txt", b"Summary: 3 logs\nStatus: OK\n")
+
+
+# ======================================================================================
+def generate_deep_tree(path: Path, scale: float) -> None:
+    # Like an installed toolchain, i.e. many nested directories with few files each.
+    rng = random.Random(44)
+    with ZipFile(path, "w", ZIP_DEFLATED) as zip_file:
+        for i in range(int(5000 * scale)):
+            depth = rng.randint(1, 40)
+            dirs = "/".join(f"level{d}-{rng.randint(0, 2)}" for d in range(depth))
+            content = b"".join(log_lines(rng, rng.randint(100, 2000)))
+            zip_file.writestr(f"install/{dirs}/file-{i}.txt", content)
+
+
+ARCHIVE_SHAPES: Dict[str, Callable[[Path, float], None]] = {
+    "many-small": generate_many_small_files,
+    "huge-logs": generate_few_huge_logs,
+    "deep-tree": generate_deep_tree,
+}
+
+
+# ======================================================================================
+class RangeServer(ThreadingHTTPServer):
+    """Local stand-in for storage.googleapis.com, which counts the bytes it sent."""
+
+    daemon_threads = True
+
+    def __init__(self, root_dir: Path, latency: float):
+        super().__init__(("127.0.0.1", 0), RangeRequestHandler)
+        self.root_dir = root_dir
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.stats: Counter[str] = Counter()
+
+    # --------------------------------------------------------------------------
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/cp2k-ci"
+
+    # --------------------------------------------------------------------------
+    def record(self, key: str, value: int = 1) -> None:
+        with self.lock:
+            self.stats[key] += value
+
+
+# ======================================================================================
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real thing
+    disable_nagle_algorithm = True  # otherwise small responses take 40ms
+    server: RangeServer
+
+    # --------------------------------------------------------------------------
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+    # --------------------------------------------------------------------------
+    def do_HEAD(self) -> None:
+        self.serve(send_body=False)
+
+    # --------------------------------------------------------------------------
+    def do_GET(self) -> None:
+        self.serve(send_body=True)
+
+    # --------------------------------------------------------------------------
+    def serve(self, send_body: bool) -> None:
+        self.server.record("requests")
+        if self.server.latency:
+            sleep(self.server.latency)
+
+        name = os.path.basename(unquote(urlsplit(self.path).path))
+        path = self.server.root_dir / name
+        if not path.is_file():
+            return self.send_empty(404)
+        stat = path.stat()
+        generation = str(stat.st_mtime_ns)
+        if self.headers.get("x-goog-if-generation-match", generation) != generation:
+            return self.send_empty(412)
+
+        start, end = 0, stat.st_size  # end is exclusive
+        range_match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if range_match:
+            start = int(range_match.group(1))
+            if range_match.group(2):
+                end = min(int(range_match.group(2)) + 1, stat.st_size)
+            if start >= end:
+                return self.send_empty(416)
+
+        self.send_response(206 if range_match else 200)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{generation}"')
+        self.send_header("x-goog-generation", generation)
+        if range_match:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{stat.st_size}")
+        self.end_headers()
+        if send_body:
+            self.send_file_range(path, start, end)
+
+    # --------------------------------------------------------------------------
+    def send_file_range(self, path: Path, start: int, end: int) -> None:
+        with open(path, "rb") as f:
+            f.seek(start)
+            while start < end:
+                chunk = f.read(min(COPY_CHUNK_SIZE, end - start))
+                try:
+                    self.wfile.write(chunk)
+                except ConnectionError:
+                    self.close_connection = True
+                    return  # The client stopped reading.
+                self.server.record("bytes", len(chunk))
+                start += len(chunk)
+
+    # --------------------------------------------------------------------------
+    def send_empty(self, status: int) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+# ======================================================================================
+@dataclass
+class BenchmarkRequest:
+    name: str
+    path: str
+    headers: Dict[str, str]
+
+
+# ======================================================================================
+def plan_requests(archive_path: Path) -> List[BenchmarkRequest]:
+    # Picks representative paths from the archive, mimicking a user's clicks.
+    with ZipFile(archive_path) as zip_file:
+        infos = [i for i in zip_file.infolist() if not i.is_dir()]
+    smallest = min(infos, key=lambda i: i.file_size)
+    largest = max(infos, key=lambda i: i.file_size)
+    deepest = max(infos, key=lambda i: i.filename.count("/"))
+    busiest = Counter(
+        i.filename.rsplit("/", 1)[0] + "/" for i in infos if "/" in i.filename
+    )
+    gzip = {"Accept-Encoding": "gzip"}
+
+    requests = [
+        BenchmarkRequest("list root", "", {}),
+        BenchmarkRequest("list deepest", deepest.filename.rsplit("/", 1)[0] + "/", {}),
+    ]
+    if busiest:
+        largest_dir = busiest.most_common(1)[0][0]
+        requests.append(BenchmarkRequest("list largest", largest_dir, {}))
+    requests.append(BenchmarkRequest("get smallest", smallest.filename, gzip))
+    requests.append(BenchmarkRequest("get largest gzip", largest.filename, gzip))
+    requests.append(BenchmarkRequest("get largest", largest.filename, {}))
+    stored = [i for i in infos if i.compress_type == ZIP_STORED and i.file_size > MiB]
+    if stored:
+        headers = {"Range": f"bytes={stored[0].file_size - MiB}-"}
+        requests.append(BenchmarkRequest("get tail MiB", stored[0].filename, headers))
+    return requests
+
+
+# ======================================================================================
+@dataclass
+class Measurement:
+    status: int
+    latency: float  # until the last byte was received
+    first_byte: float
+    upstream_requests: int
+    upstream_bytes: int
+    response_bytes: int
+    peak_rss_growth: int
+
+
+# ======================================================================================
+def measure(
+    server: RangeServer, archive: str, request: BenchmarkRequest, cold: bool = False
+) -> Measurement:
+    if cold:
+        frontend.zip_directories.discard(archive)
+    stats_before = server.stats.copy()
+    client = frontend.app.test_client()
+    url = f"/artifacts/{archive}/{request.path}"
+    with rss_sampler() as peak_rss:
+        start = monotonic()
+        response = client.get(url, headers=request.headers, buffered=False)
+        first_byte, response_bytes = None, 0
+        for chunk in response.iter_encoded():
+            first_byte = first_byte or monotonic() - start
+            response_bytes += len(chunk)
+        response.close()
+        latency = monotonic() - start
+    stats = server.stats - stats_before
+    return Measurement(
+        status=response.status_code,
+        latency=latency,
+        first_byte=first_byte or latency,
+        upstream_requests=stats["requests"],
+        upstream_bytes=stats["bytes"],
+        response_bytes=response_bytes,
+        peak_rss_growth=peak_rss[0],
+    )
+
+
+# ======================================================================================
+def current_rss() -> int:
+    try:
+        resident_pages = int(Path("/proc/self/statm").read_text().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except OSError:  # Not Linux, fall back to the peak since the process started.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# ======================================================================================
+@contextmanager
+def rss_sampler(interval: float = 0.002) -> Iterator[List[int]]:
+    # Yields a list, whose only element becomes the peak growth of the resident set.
+    baseline = current_rss()
+    result = [0]
+    done = threading.Event()
+
+    def sample() -> None:
+        while not done.wait(interval):
+            result[0] = max(result[0], current_rss() - baseline)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield result
+    finally:
+        done.set()
+        sampler.join()
+        result[0] = max(result[0], current_rss() - baseline)
+
+
+# ======================================================================================
+def print_header() -> None:
+    line = f"{'archive':<11} {'request':<17} {'mode':<4} {'status':>6}"
+    line += f" {'latency[ms]':>11} {'ttfb[ms]':>9} {'upstream req':>12}"
+    line += f" {'upstream bytes':>14} {'response bytes':>14} {'rss[MiB]':>8}"
+    print(line)
+
+
+# ======================================================================================
+def print_result(
+    shape: str, request: BenchmarkRequest, mode: str, results: List[Measurement]
+) -> None:
+    # Shows the median latencies and the maxima of everything else.
+    latency = 1e3 * statistics.median(r.latency for r in results)
+    first_byte = 1e3 * statistics.median(r.first_byte for r in results)
+    line = f"{shape:<11} {request.name:<17} {mode:<4}"
+    line += f" {max(r.status for r in results):>6}"
+    line += f" {latency:>11.1f} {first_byte:>9.1f}"
+    line += f" {max(r.upstream_requests for r in results):>12}"
+    line += f" {max(r.upstream_bytes for r in results):>14}"
+    line += f" {max(r.response_bytes for r in results):>14}"
+    line += f" {max(r.peak_rss_growth for r in results) / MiB:>8.1f}"
+    print(line)
+
+
+# ======================================================================================
+if __name__ == "__main__":
+    main()
+
+# EOF
@@ -2,34 +2,92 @@
 
 # author: Ole Schuett
 
+import io
 import os
 import json
 import hmac
+import struct
 import hashlib
 import logging
+import threading
+from time import monotonic
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from flask import Flask, request, abort, Response
 import urllib.parse
 import mimetypes
-import os
-import fsspec  # type: ignore
-from zipfile import ZipFile
-from typing import Any
+import requests
+from requests.adapters import HTTPAdapter
+from zipfile import ZipFile, ZipInfo, ZipExtFile, ZIP_STORED, ZIP_DEFLATED
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import google.auth
 import google.cloud.pubsub  # type: ignore
 
-# For debugging fsspec:
-# import logging
-# logging.basicConfig(level=logging.DEBUG)
+ARTIFACTS_BASE_URL = "https://storage.googleapis.com/cp2k-ci"
+
+# Limits of the cache for the central directories of artifact archives.
+ZIP_DIRECTORY_CACHE_BYTES = int(os.environ.get("ZIP_DIRECTORY_CACHE_BYTES", 64 << 20))
+ZIP_DIRECTORY_CACHE_ENTRIES = int(os.environ.get("ZIP_DIRECTORY_CACHE_ENTRIES", 256))
+
+# The last 512 KiB of an archive usually contain its entire central directory.
+ZIP_DIRECTORY_PREFETCH = 512 * 1024
+
+# The local extra field may be larger than the one in the central directory.
+LOCAL_HEADER_SLACK = 1024
+
+# Large directory listings are split into pages with this many entries.
+LISTING_PAGE_SIZE = 1000
+
+# Members are streamed to the client in chunks of this size.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Minimal gzip header without file name and modification time, see RFC 1952.
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
 
-publish_client = google.cloud.pubsub.PublisherClient()
+# Messages are published in batches, which get sent after 50ms at the latest.
+batch_settings = google.cloud.pubsub.types.BatchSettings(max_latency=0.05)
+
+# GitHub events and actions handled by process_github_event() in the backend.
+HANDLED_GITHUB_EVENTS = {
+    ("pull_request", "opened"),
+    ("pull_request", "reopened"),
+    ("pull_request", "synchronize"),
+    ("pull_request", "closed"),
+    ("check_suite", "rerequested"),
+    ("check_run", "rerequested"),
+    ("check_run", "requested_action"),
+}
+
+# Fields of GitHub events that are read by the backend, everything else is dropped.
+USER_FIELDS = {"login": True, "id": True}
+GITHUB_EVENT_FIELDS = {
+    "action": True,
+    "repository": {"name": True},
+    "sender": USER_FIELDS,
+    "pull_request": {"number": True, "merged": True, "user": USER_FIELDS},
+    "check_suite": {"check_runs_url": True, "pull_requests": {"number": True}},
+    "check_run": {"external_id": True},
+    "requested_action": {"identifier": True},
+    "issue": {"number": True, "pull_request": {"url": True}},
+    "comment": {
+        "body": True,
+        "html_url": True,
+        "user": USER_FIELDS,
+        "reactions": {"url": True},
+    },
+}
 
 app = Flask(__name__)
 app.config["GITHUB_WEBHOOK_SECRET"] = os.environ["GITHUB_WEBHOOK_SECRET"]
 app.logger.setLevel(logging.INFO)
 
-project: str = google.auth.default()[1] or ""
-pubsub_topic = "projects/" + project + "/topics/cp2kci-topic"
+# The publisher gets created upon the first message, e.g. benchmark.py needs none.
+publisher_lock = threading.Lock()
+publisher: Optional[Tuple[Any, str]] = None  # client and topic
+
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_maxsize=16))
 
 app.logger.info("CP2K-CI frontend is up and running :-)")
 
@@ -44,7 +102,7 @@ def robots() -> Response:
 @app.route("/health")
 def healthz() -> str:
     # TODO: find a way to return queue size or some other end-to-end health metric.
-    message_backend(rpc="update_healthz_beacon")
+    message_backend(rpc="update_healthz_beacon").result()
     return "I feel good :-)"
 
 
@@ -63,59 +121,450 @@ def github_app_webhook() -> str:
     action = body.get("action", "")
     app.logger.info("Got github even: {} action: {}".format(event, action))
 
-    # Forward everything to the backend.
-    message_backend(rpc="github_event", event=event, body=body)
+    if not is_handled_github_event(event, body):
+        return "Ok - ignored event."
+
+    # GitHub might deliver an event more than once, e.g. after a timeout.
+    delivery_id = request.headers.get("X-GitHub-Delivery", "")
+    if delivery_id and not recent_deliveries.add(delivery_id):
+        return "Ok - ignored duplicate delivery."
+
+    # Forward the relevant parts to the backend without waiting for Pub/Sub.
+    slim_body = project_fields(body, GITHUB_EVENT_FIELDS)
+    future = message_backend(rpc="github_event", event=event, body=slim_body)
+
+    def on_published(future: Any) -> None:
+        if future.exception():
+            app.logger.error(f"Could not forward delivery {delivery_id}.")
+            recent_deliveries.discard(delivery_id)  # Allow a redelivery.
+
+    future.add_done_callback(on_published)
     return "Ok - queued backend task."
 
 
 # ======================================================================================
-def message_backend(**args: Any) -> None:
+def is_handled_github_event(event: str, body: Any) -> bool:
+    if event == "issue_comment":
+        return "pull_request" in body["issue"] and "/cp2kci" in body["comment"]["body"]
+    return (event, body.get("action", "")) in HANDLED_GITHUB_EVENTS
+
+
+# ======================================================================================
+def project_fields(value: Any, fields: Any) -> Any:
+    # Returns a copy of value that contains only the given (nested) fields.
+    if fields is True:
+        return value
+    if isinstance(value, list):
+        return [project_fields(v, fields) for v in value]
+    if isinstance(value, dict):
+        return {k: project_fields(value[k], f) for k, f in fields.items() if k in value}
+    return value
+
+
+# ======================================================================================
+class DeliveryLog:
+    """Thread-safe set of recently seen webhook deliveries with bounded size."""
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, float] = OrderedDict()  # id -> time of arrival
+
+    # --------------------------------------------------------------------------
+    def add(self, delivery_id: str) -> bool:
+        # Returns False if the delivery has been seen before.
+        now = monotonic()
+        with self.lock:
+            while self.entries:
+                oldest_id, arrival = next(iter(self.entries.items()))
+                if (
+                    arrival > now - self.ttl_seconds
+                    and len(self.entries) < self.max_size
+                ):
+                    break
+                del self.entries[oldest_id]
+            if delivery_id in self.entries:
+                return False
+            self.entries[delivery_id] = now
+            return True
+
+    # --------------------------------------------------------------------------
+    def discard(self, delivery_id: str) -> None:
+        with self.lock:
+            self.entries.pop(delivery_id, None)
+
+
+recent_deliveries = DeliveryLog(ttl_seconds=60 * 60, max_size=10000)
+
+
+# ======================================================================================
+def message_backend(**args: Any) -> Any:
+    # Returns a future, which resolves once the message has been published.
+    global publisher
+    with publisher_lock:
+        if not publisher:
+            project = google.auth.default()[1] or ""
+            client = google.cloud.pubsub.PublisherClient(batch_settings=batch_settings)
+            publisher = client, "projects/" + project + "/topics/cp2kci-topic"
+    publish_client, pubsub_topic = publisher
     data = json.dumps(args).encode("utf8")
-    future = publish_client.publish(pubsub_topic, data)
-    future.result()
+    return publish_client.publish(pubsub_topic, data)
+
+
+# ======================================================================================
+@dataclass
+class DirectoryNode:
+    dirs: Dict[str, "DirectoryNode"] = field(default_factory=dict)
+    files: Dict[str, int] = field(default_factory=dict)  # name -> uncompressed size
+    listing: List[Tuple[str, Optional[int]]] = field(default_factory=list)  # sorted
+
+    # --------------------------------------------------------------------------
+    def insert(self, path: str, size: int) -> None:
+        node = self
+        *dir_names, file_name = path.split("/")
+        for name in dir_names:
+            node = node.dirs.setdefault(name, DirectoryNode())
+        node.files[file_name] = size
+
+    # --------------------------------------------------------------------------
+    def lookup(self, path: str) -> Optional["DirectoryNode"]:
+        # Expects an empty path or one that ends with a slash.
+        node: Optional[DirectoryNode] = self
+        for name in path.split("/")[:-1]:
+            node = node.dirs.get(name) if node else None
+        return node
+
+    # --------------------------------------------------------------------------
+    def seal(self) -> None:
+        # Sorts the listings once, so that serving them costs O(page size).
+        self.listing = [(name, None) for name in sorted(self.dirs)]
+        self.listing += sorted(self.files.items())
+        for node in self.dirs.values():
+            node.seal()
+
+
+# ======================================================================================
+@dataclass
+class ZipDirectory:
+    url: str
+    generation: Optional[str]  # x-goog-generation
+    etag: Optional[str]
+    size: int
+    members: Dict[str, ZipInfo]  # files only, no directories
+    weight: int  # rough estimate of the memory footprint in bytes
+    data_offsets: Dict[str, int] = field(default_factory=dict)  # from local headers
+    root: DirectoryNode = field(default_factory=DirectoryNode)
+
+    # --------------------------------------------------------------------------
+    def precondition(self) -> Dict[str, str]:
+        # Makes a request fail with 412 if the archive has been replaced meanwhile.
+        if self.generation:
+            return {"x-goog-if-generation-match": self.generation}
+        if self.etag:
+            return {"If-Match": self.etag}
+        return {}
+
+
+# ======================================================================================
+class ZipDirectoryCache:
+    """Thread-safe LRU cache of parsed zip directories, keyed by archive name."""
+
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, ZipDirectory] = OrderedDict()
+        self.size = 0
+
+    # --------------------------------------------------------------------------
+    def get(self, archive: str) -> Optional[ZipDirectory]:
+        with self.lock:
+            directory = self.entries.get(archive)
+            if directory:
+                self.entries.move_to_end(archive)
+            return directory
+
+    # --------------------------------------------------------------------------
+    def put(self, archive: str, directory: ZipDirectory) -> None:
+        with self.lock:
+            self._discard(archive)
+            self.entries[archive] = directory
+            self.size += directory.weight
+            while len(self.entries) > 1 and (
+                self.size > self.max_bytes or len(self.entries) > self.max_entries
+            ):
+                self._discard(next(iter(self.entries)))
+
+    # --------------------------------------------------------------------------
+    def discard(self, archive: str) -> None:
+        with self.lock:
+            self._discard(archive)
+
+    # --------------------------------------------------------------------------
+    def _discard(self, archive: str) -> None:
+        if archive in self.entries:
+            self.size -= self.entries.pop(archive).weight
+
+
+zip_directories = ZipDirectoryCache(
+    ZIP_DIRECTORY_CACHE_BYTES, ZIP_DIRECTORY_CACHE_ENTRIES
+)
+
+
+# ======================================================================================
+class RemoteFile:
+    """Read-only file that fetches byte ranges on demand, except for a prefetched tail."""
+
+    def __init__(self, directory: ZipDirectory, tail: bytes):
+        self.directory = directory
+        self.tail = tail
+        self.tail_start = directory.size - len(tail)
+        self.pos = 0
+
+    # --------------------------------------------------------------------------
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.directory.size
+        self.pos = offset
+        return self.pos
+
+    # --------------------------------------------------------------------------
+    def tell(self) -> int:
+        return self.pos
+
+    # --------------------------------------------------------------------------
+    def read(self, n: int = -1) -> bytes:
+        end = self.directory.size if n < 0 else min(self.pos + n, self.directory.size)
+        if self.pos >= end:
+            return b""
+        data = b""
+        if self.pos < self.tail_start:
+            fetch_end = min(end, self.tail_start)
+            data = fetch_range(self.directory, self.pos, fetch_end).content
+        if end > self.tail_start:
+            offset = max(self.pos - self.tail_start, 0)
+            data += self.tail[offset : end - self.tail_start]
+        self.pos += len(data)
+        return data
+
+
+# ======================================================================================
+def fetch_range(directory: ZipDirectory, start: int, end: int) -> requests.Response:
+    # Fetches the bytes from start to end (exclusive) of given archive.
+    headers = {"Range": f"bytes={start}-{end - 1}", **directory.precondition()}
+    response = http_session.get(directory.url, headers=headers)
+    response.raise_for_status()
+    return response
+
+
+# ======================================================================================
+def load_zip_directory(archive: str) -> Optional[ZipDirectory]:
+    archive_quoted = urllib.parse.quote(archive)
+    url = f"{ARTIFACTS_BASE_URL}/{archive_quoted}_artifacts.zip"
+    head = http_session.head(url)
+    if head.status_code == 404:
+        return None  # Artifact not found.
+    head.raise_for_status()
+
+    generation = head.headers.get("x-goog-generation")
+    etag = head.headers.get("ETag")
+    cached = zip_directories.get(archive)
+    if cached and cached.generation == generation and cached.etag == etag:
+        return cached
+
+    size = int(head.headers["Content-Length"])
+    directory = ZipDirectory(url, generation, etag, size, members={}, weight=0)
+    prefetch = min(ZIP_DIRECTORY_PREFETCH, size)
+    tail = fetch_range(directory, size - prefetch, size).content
+    with ZipFile(RemoteFile(directory, tail)) as zip_file:
+        for info in zip_file.infolist():
+            if not info.is_dir():
+                directory.members[info.filename] = info
+                directory.root.insert(info.filename, info.file_size)
+            directory.weight += 500 + 2 * len(info.filename) + len(info.extra)
+    directory.root.seal()
+    zip_directories.put(archive, directory)
+    return directory
+
+
+# ======================================================================================
+class MemberReader:
+    """Reads a slice of a zip member's compressed data from a streamed ranged response.
+
+    If the response ends prematurely the remainder is fetched with another request.
+    """
+
+    def __init__(self, directory: ZipDirectory, response: Any, pos: int, end: int):
+        self.directory = directory
+        self.response = response
+        self.pos = pos
+        self.end = end
+
+    # --------------------------------------------------------------------------
+    def read(self, n: int = -1) -> bytes:
+        n = self.end - self.pos if n < 0 else min(n, self.end - self.pos)
+        if n <= 0:
+            return b""
+        data = self.response.raw.read(n)
+        if not data:  # Local extra field exceeded our slack.
+            self.response.close()
+            self.response = open_range(self.directory, self.pos, self.end)
+            data = self.response.raw.read(n)
+        self.pos += len(data)
+        return bytes(data)
+
+    # --------------------------------------------------------------------------
+    def close(self) -> None:
+        if self.pos >= self.end:
+            self.response.raw.read()  # Drain the slack to allow connection reuse.
+        self.response.close()
+
+
+# ======================================================================================
+def open_range(directory: ZipDirectory, start: int, end: int) -> requests.Response:
+    # Like fetch_range(), but streams the response body.
+    headers = {"Range": f"bytes={start}-{end - 1}", **directory.precondition()}
+    response = http_session.get(directory.url, headers=headers, stream=True)
+    response.raise_for_status()
+    return response
+
+
+# ======================================================================================
+def read_local_header(stream: Any) -> int:
+    # Returns the length of the local header, after which the member's data begins.
+    header = stream.read(30)
+    if len(header) != 30 or header[:4] != b"PK\x03\x04":
+        raise Exception("Bad local header in zip archive.")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    stream.read(name_length + extra_length)
+    return int(30 + name_length + extra_length)
+
+
+# ======================================================================================
+def open_member(
+    directory: ZipDirectory, info: ZipInfo, start: int = 0, stop: int = -1
+) -> MemberReader:
+    # Opens the member's compressed data from start to stop (exclusive).
+    stop = info.compress_size if stop < 0 else stop
+    data_offset = directory.data_offsets.get(info.filename)
+    if data_offset is None:
+        name_length = len(info.orig_filename.encode("utf8"))
+        header_size = 30 + name_length + len(info.extra) + LOCAL_HEADER_SLACK
+        if start == 0:  # Fetch local header and data with a single read.
+            end = min(info.header_offset + header_size + stop, directory.size)
+            response = open_range(directory, info.header_offset, end)
+            data_offset = info.header_offset + read_local_header(response.raw)
+            directory.data_offsets[info.filename] = data_offset
+            return MemberReader(directory, response, data_offset, data_offset + stop)
+        end = min(info.header_offset + header_size, directory.size)
+        header = fetch_range(directory, info.header_offset, end).content
+        data_offset = info.header_offset + read_local_header(io.BytesIO(header))
+        directory.data_offsets[info.filename] = data_offset
+
+    response = open_range(directory, data_offset + start, data_offset + stop)
+    return MemberReader(directory, response, data_offset + start, data_offset + stop)
+
+
+# ======================================================================================
+def iterate_chunks(
+    stream: Any, prefix: bytes = b"", suffix: bytes = b""
+) -> Iterator[bytes]:
+    try:
+        yield prefix
+        while True:
+            chunk = stream.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        yield suffix
+    finally:
+        stream.close()
 
 
 # ======================================================================================
 @app.route("/artifacts/<archive>/")
 @app.route("/artifacts/<archive>/<path:path>")
 def artifacts(archive: str, path: str = "") -> Response:
-    fs = fsspec.filesystem("https")
-    archive_quoted = urllib.parse.quote(archive)
-    url = f"https://storage.googleapis.com/cp2k-ci/{archive_quoted}_artifacts.zip"
-    try:
-        with fs.open(url, block_size=512 * 1024) as remote_file:
-            # Pre-fetch last 512 KiB as this contains the zip archive's directory.
-            prefetch = min(512 * 1024, remote_file.size)
-            remote_file.seek(-prefetch, os.SEEK_END)
-            remote_file.read()
-            remote_file.seek(0)
-            with ZipFile(remote_file) as zip_file:
-                return browse_zipfile(zip_file, path)
-    except FileNotFoundError:
+    # Try cached directory first, the ranged read fails if the archive was replaced.
+    directory = zip_directories.get(archive)
+    if directory and path in directory.members:
+        try:
+            return serve_member(directory, path)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 412:
+                raise
+            zip_directories.discard(archive)
+
+    directory = load_zip_directory(archive)
+    if not directory:
         return Response("Artifact not found.", status=404)
+    return browse_zipfile(directory, path)
 
 
 # ======================================================================================
-def browse_zipfile(zip_file: ZipFile, path: str) -> Response:
-    filenames = {i.filename for i in zip_file.infolist() if not i.is_dir()}
+def serve_member(directory: ZipDirectory, path: str) -> Response:
+    for ext in [".log", ".out", ".inp"]:
+        mimetypes.add_type("text/plain", ext)
+    mt = mimetypes.guess_type(path)[0]
+    info = directory.members[path]
+
+    if info.compress_type == ZIP_STORED:
+        size = info.file_size
+        byte_range = request.range.range_for_length(size) if request.range else None
+        if request.range and not byte_range:
+            headers = {"Content-Range": f"bytes */{size}"}
+            return Response("Range not satisfiable.", status=416, headers=headers)
+        start, stop = byte_range or (0, size)
+        reader = open_member(directory, info, start, stop)
+        response = Response(iterate_chunks(reader), mimetype=mt)
+        response.headers["Accept-Ranges"] = "bytes"
+        response.content_length = stop - start
+        if byte_range:
+            response.status_code = 206
+            response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        return response
+
+    if info.compress_type == ZIP_DEFLATED and request.accept_encodings["gzip"]:
+        # Wrapping the raw deflate stream into a gzip container needs no recompression.
+        reader = open_member(directory, info)
+        trailer = struct.pack("<LL", info.CRC, info.file_size & 0xFFFFFFFF)
+        response = Response(iterate_chunks(reader, GZIP_HEADER, trailer), mimetype=mt)
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+        response.content_length = len(GZIP_HEADER) + info.compress_size + len(trailer)
+        return response
+
+    # ZipExtFile takes care of decompression and CRC checking.
+    member = ZipExtFile(open_member(directory, info), "r", info, None, True)
+    response = Response(iterate_chunks(member), mimetype=mt)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.content_length = info.file_size
+    return response
 
-    if path in filenames:
-        for ext in [".log", ".out", ".inp"]:
-            mimetypes.add_type("text/plain", ext)
-        mt = mimetypes.guess_type(path)[0]
-        with zip_file.open(path) as f:
-            return Response(f.read(), mimetype=mt)
+
+# ======================================================================================
+def browse_zipfile(directory: ZipDirectory, path: str) -> Response:
+    if path in directory.members:
+        return serve_member(directory, path)
 
     if path and not path.endswith("/"):
         return Response("File not found.", status=404)
 
-    candidates = {fn[len(path) :] for fn in filenames if fn.startswith(path)}
-    if not candidates:
+    node = directory.root.lookup(path)
+    if not node:
         return Response("Directory not found", status=404)
 
     # List directory.
-    sub_dirs = {fn.split("/", 1)[0] for fn in candidates if "/" in fn}
-    files = {fn for fn in candidates if "/" not in fn}
+    num_pages = max(1, -(-len(node.listing) // LISTING_PAGE_SIZE))
+    page = request.args.get("page", 1, type=int)
+    if not 1 <= page <= num_pages:
+        return Response("Page not found", status=404)
+    offset = (page - 1) * LISTING_PAGE_SIZE
+    entries = node.listing[offset : offset + LISTING_PAGE_SIZE]
+
     title = f"Content of /{path}"
     output = ["<html>"]
     output += [f"<head><title>{title}</title></head>"]
@@ -123,15 +572,37 @@ def browse_zipfile(zip_file: ZipFile, path: str) -> Response:
     output += [f"<ul style='list-style-type:none;padding:10px;'>"]
     if path:
         output += [f"<li><a href='../'>📁 ..<a></li>"]
-    for name in sub_dirs:
-        output += [f"<li><a href='./{name}/'>📁 {name}/<a></li>"]
-    for name in files:
-        output += [f"<li><a href='./{name}'>📄 {name}<a></li>"]
+    for name, size in entries:
+        if size is None:
+            output += [f"<li><a href='./{name}/'>📁 {name}/<a></li>"]
+        else:
+            output += [
+                f"<li><a href='./{name}'>📄 {name}<a> ({format_size(size)})</li>"
+            ]
     output += [f"</ul>"]
+    if num_pages > 1:
+        output += [f"<p>Page {page} of {num_pages}:"]
+        if page > 1:
+            output += [f"<a href='?page={page - 1}'>previous</a>"]
+        if page < num_pages:
+            output += [f"<a href='?page={page + 1}'>next</a>"]
+        output += ["</p>"]
     output += ["</body></html>"]
     return Response("\n".join(output))
 
 
+# ======================================================================================
+def format_size(size: int) -> str:
+    if size < 1024:
+        return f"{size} B"
+    value = size / 1024
+    for unit in ["KiB", "MiB"]:
+        if value < 1024:
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} GiB"
+
+
 # ======================================================================================
 if __name__ == "__main__":
     app.run()
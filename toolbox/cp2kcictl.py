@@ -20,7 +20,7 @@ def main() -> None:
         print_usage()
 
     rpc = sys.argv[1]
-    if rpc == "submit_all_dashboard_tests":
+    if rpc in ("submit_all_dashboard_tests", "rebuild_dashboard_manifest"):
         message_backend(rpc=rpc)
 
     elif rpc == "submit_tagged_dashboard_tests":
@@ -55,7 +55,8 @@ def print_usage() -> None:
     print("                      submit_dashboard_test <target> |")
     print("                      submit_dashboard_test_force <target> |")
     print("                      submit_tagged_dashboard_tests <tag> |")
-    print("                      submit_all_dashboard_tests ]")
+    print("                      submit_all_dashboard_tests |")
+    print("                      rebuild_dashboard_manifest ]")
     sys.exit(1)
 
 
@@ -8,6 +8,7 @@ import sys
 import time
 import pathlib
 import requests
+from typing import List
 from requests.auth import HTTPBasicAuth
 from bs4 import BeautifulSoup
 
@@ -63,8 +64,11 @@ def main():
                 for pre in soup.find_all("pre"):
                     output.append(pre.get_text())
 
+        finished = pipeline_status not in ("created", "pending", "running")
+        if finished:
+            output += format_trailer(output)
         upload_report("\n".join(output))
-        if pipeline_status not in ("created", "pending", "running"):
+        if finished:
             sys.exit(0)
 
         print("Sleeping 30 sec...\n")
@@ -89,6 +93,21 @@ def format_title(title: str):
     ]
 
 
+# ======================================================================================
+def format_trailer(output: List[str]):
+    # Machine-readable trailer, which allows the backend to read only the tail.
+    lines = re.split(r"[\n\r]", "\n".join(output))
+    summaries = [line[9:] for line in lines if line.startswith("Summary: ")]
+    statuses = [line[8:] for line in lines if line.startswith("Status: ")]
+    commit_shas = [line[11:] for line in lines if line.startswith("CommitSHA: ")]
+    return [
+        "",
+        f"CP2K-CI-Summary: {summaries[-1] if summaries else ''}",
+        f"CP2K-CI-Status: {statuses[-1] if statuses else ''}",
+        f"CP2K-CI-CommitSHA: {commit_shas[0] if commit_shas else ''}",
+    ]
+
+
 # ======================================================================================
 def upload_report(content: str):
     url = os.environ["REPORT_UPLOAD_URL"]
@@ -6,7 +6,7 @@
 set -o pipefail
 
 # Check input.
-for key in TARGET DOCKERFILE BUILD_ARGS BUILD_PATH USE_CACHE CACHE_FROM NUM_GPUS_REQUIRED GIT_REPO GIT_BRANCH GIT_REF REPORT_UPLOAD_URL ARTIFACTS_UPLOAD_URL ; do
+for key in TARGET DOCKERFILE BUILD_ARGS BUILD_PATH USE_CACHE CACHE_FROM NUM_GPUS_REQUIRED GIT_REPO GIT_BRANCH GIT_REF REPORT_UPLOAD_URL REPORT_RESUMABLE_URL ARTIFACTS_UPLOAD_URL ; do
     value="$(eval echo \$${key})"
     echo "${key}=\"${value}\""
 done
@@ -19,11 +19,93 @@ function upload_file {
     wget --quiet --output-document=- --method=PUT --header="content-type: ${content_type}" --header="cache-control: no-cache" --body-file="${file}" "${url}" > /dev/null
 }
 
-# Append end date and upload report.
+# The report is appended to a resumable upload session, which only sends new bytes.
+# The session's object becomes visible upon finalization, in the meantime a preview
+# of the report's head and tail is uploaded. Both end up in the same report object,
+# hence should the job die before finalization, the preview remains.
+RESUMABLE_CHUNK_SIZE=$((256 * 1024))  # Required granularity of non-final chunks.
+PREVIEW_HEAD_SIZE=$((64 * 1024))  # Contains the CommitSHA and other header fields.
+PREVIEW_TAIL_SIZE=$((1024 * 1024))
+PREVIEW_UPLOADED_SIZE=-1
+RESUMABLE_SESSION=""
+LIVE_UPLOAD_PID=""
+
+function start_resumable_report {
+    if [ -n "${REPORT_RESUMABLE_URL}" ]; then
+        RESUMABLE_SESSION=$(curl --silent --output /dev/null --dump-header - --request POST --header "x-goog-resumable: start" --header "content-type: text/plain;charset=utf-8" --header "cache-control: no-cache" "${REPORT_RESUMABLE_URL}" | tr -d '\r' | grep -i "^location: " | cut -c11-)
+    fi
+}
+
+function query_resumable_offset {
+    local range=$(curl --silent --output /dev/null --dump-header - --request PUT --header "content-range: bytes */*" --header "content-length: 0" "${RESUMABLE_SESSION}" | tr -d '\r' | grep -i "^range: " | cut -d- -f2)
+    echo $(( ${range:--1} + 1 ))
+}
+
+function upload_resumable_bytes {
+    local offset=$1
+    local length=$2
+    local total=$3
+    tail -c "+$((offset + 1))" "${REPORT}" | head -c "${length}" | curl --silent --fail --output /dev/null --request PUT --header "content-range: bytes ${offset}-$((offset + length - 1))/${total}" --data-binary @- "${RESUMABLE_SESSION}"
+}
+
+function append_report {
+    local offset=$(query_resumable_offset)
+    local size=$(stat --format=%s "${REPORT}")
+    local length=$(( (size - offset) / RESUMABLE_CHUNK_SIZE * RESUMABLE_CHUNK_SIZE ))
+    if (( length > 0 )) ; then
+        upload_resumable_bytes "${offset}" "${length}" "*"
+    fi
+}
+
+function upload_report_preview {
+    local size=$(stat --format=%s "${REPORT}")
+    if (( size == PREVIEW_UPLOADED_SIZE )) ; then
+        return  # The report is append-only, hence it has not changed.
+    fi
+    if (( size > PREVIEW_HEAD_SIZE + PREVIEW_TAIL_SIZE )) ; then
+        local omitted=$((size - PREVIEW_HEAD_SIZE - PREVIEW_TAIL_SIZE))
+        { head -c "${PREVIEW_HEAD_SIZE}" "${REPORT}" ; echo -e "\\n\\n[... ${omitted} bytes omitted until the job finishes ...]\\n" ; tail -c "${PREVIEW_TAIL_SIZE}" "${REPORT}" ; } > /tmp/report_preview.txt
+        upload_file "${REPORT_UPLOAD_URL}" /tmp/report_preview.txt "text/plain;charset=utf-8"
+    else
+        upload_file "${REPORT_UPLOAD_URL}" "${REPORT}" "text/plain;charset=utf-8"
+    fi
+    PREVIEW_UPLOADED_SIZE=${size}
+}
+
+# Fails if the session could not be finalized, e.g. because it has expired.
+function finalize_report {
+    local offset=$(query_resumable_offset)
+    local size=$(stat --format=%s "${REPORT}")
+    if (( size > offset )) ; then
+        upload_resumable_bytes "${offset}" "$((size - offset))" "${size}"
+    else
+        curl --silent --fail --output /dev/null --request PUT --header "content-range: bytes */${size}" --header "content-length: 0" "${RESUMABLE_SESSION}"
+    fi
+}
+
+# Append machine-readable trailer, which allows the backend to read only the tail.
+function append_report_trailer {
+    local summary=$(tr '\r' '\n' < "${REPORT}" | grep -a "^Summary: " | tail -n 1 | cut -c10-)
+    local status=$(tr '\r' '\n' < "${REPORT}" | grep -a "^Status: " | tail -n 1 | cut -c9-)
+    local commit_sha=$(tr '\r' '\n' < "${REPORT}" | grep -a "^CommitSHA: " | head -n 1 | cut -c12-)
+    printf "\nCP2K-CI-Summary: %s\nCP2K-CI-Status: %s\nCP2K-CI-CommitSHA: %s\n" "${summary}" "${status}" "${commit_sha}" | tee -a "${REPORT}"
+}
+
+# Append trailer and end date and upload report.
 function upload_final_report {
     local end_date=$(date --utc --rfc-3339=seconds)
+    append_report_trailer
     echo -e "\\nEndDate: ${end_date}" | tee -a "${REPORT}"
-    upload_file "${REPORT_UPLOAD_URL}" "${REPORT}" "text/plain;charset=utf-8"
+    if [ -n "${LIVE_UPLOAD_PID}" ]; then
+        kill "${LIVE_UPLOAD_PID}"
+        wait "${LIVE_UPLOAD_PID}"  # Let an ongoing upload complete.
+        LIVE_UPLOAD_PID=""
+    fi
+    # Without a finalized session the report object would remain the last preview.
+    if [ -z "${RESUMABLE_SESSION}" ] || ! finalize_report ; then
+        upload_file "${REPORT_UPLOAD_URL}" "${REPORT}" "text/plain;charset=utf-8"
+    fi
+    RESUMABLE_SESSION=""
 }
 
 # Handle preemption gracefully.
@@ -63,15 +145,21 @@ if (( NUM_GPUS_REQUIRED > 0 )) ; then
 fi
 
 # Upload preliminary report every 30s in the background.
+start_resumable_report
 (
+trap "exit 0" SIGTERM  # Deferred until the current upload has completed.
 while true ; do
     sleep 1
     count=$(( (count + 1) % 30 ))
-    if (( count == 1 )) && [ -n "${REPORT_UPLOAD_URL}" ]; then
-        upload_file "${REPORT_UPLOAD_URL}" "${REPORT}" "text/plain;charset=utf-8"
+    if (( count == 1 )) && [ -n "${RESUMABLE_SESSION}" ]; then
+        append_report
+        upload_report_preview
+    elif (( count == 1 )) && [ -n "${REPORT_UPLOAD_URL}" ]; then
+        upload_report_preview
     fi
 done
 )&
+LIVE_UPLOAD_PID=$!
 
 # Start docker deamon.
 /opt/cp2kci-toolbox/start_stuff.sh
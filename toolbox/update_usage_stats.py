@@ -2,11 +2,16 @@
 
 # author: Ole Schuett
 
+import io
 import sys
-from datetime import datetime, timezone
-from dataclasses import dataclass
+import csv
+import json
+import math
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass, field
 from collections import defaultdict
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import google.auth  # type: ignore
 import google.cloud.storage  # type: ignore
@@ -15,56 +20,330 @@ gcp_project = google.auth.default()[1]
 storage_client = google.cloud.storage.Client(project=gcp_project)
 output_bucket = storage_client.get_bucket("cp2k-ci")
 
+ROLLUP_PATH = "usage_stats_rollup.json"
+ROLLUP_VERSION = 2  # Rollups of other versions are rebuilt from scratch.
+
+# Reports are still rewritten and patched while their job is running. Jobs live at
+# most 12 hours, hence older reports are final and can be folded into the rollup.
+SETTLE_WINDOW = timedelta(hours=24)
+
+# Blob names are not ordered by creation time and listings can not be filtered by
+# time. Hence every run still has to list all report names, but it does so in
+# parallel shards and only fetches the fields it needs. Since all target names share
+# the "cp2k-" prefix, the shards split on the character that follows it. The first
+# and last shard pick up any reports that are named differently.
+SHARD_PREFIX = "run-cp2k-"
+SHARD_BOUNDARIES = [SHARD_PREFIX + c for c in "0123456789abcdefghijklmnopqrstuvwxyz"]
+LISTING_FIELDS = "items(name,timeCreated,metadata),nextPageToken"
+
+# Durations are binned logarithmically into four buckets per doubling, which keeps
+# the histograms small and mergeable while percentiles stay within 19%.
+BUCKETS_PER_DOUBLING = 4
+PERCENTILES = (50, 90, 99)
+NUM_WORST_OFFENDERS = 5
+
+
+# ======================================================================================
+@dataclass
+class Histogram:
+    buckets: Dict[int, int] = field(default_factory=dict)
+    worst: List[Tuple[float, str]] = field(default_factory=list)  # (seconds, report)
+
+    def add(self, seconds: float, report_name: str) -> None:
+        i = math.ceil(BUCKETS_PER_DOUBLING * math.log2(max(seconds, 1.0)))
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+        self.add_worst([(seconds, report_name)])
+
+    def add_worst(self, offenders: List[Tuple[float, str]]) -> None:
+        self.worst = sorted(self.worst + offenders, reverse=True)
+        del self.worst[NUM_WORST_OFFENDERS:]
+
+    def merge(self, other: "Histogram") -> None:
+        for i, n in other.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + n
+        self.add_worst(other.worst)
+
+    def percentile(self, p: float) -> Optional[int]:
+        # Returns the upper bound of the bucket that contains the percentile.
+        total = sum(self.buckets.values())
+        accumulated = 0
+        for i in sorted(self.buckets):
+            accumulated += self.buckets[i]
+            if 100 * accumulated >= p * total:
+                return round(2 ** (i / BUCKETS_PER_DOUBLING))
+        return None
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"buckets": self.buckets, "worst": self.worst}
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> "Histogram":
+        buckets = {int(i): n for i, n in data["buckets"].items()}
+        worst = [(seconds, name) for seconds, name in data["worst"]]
+        return Histogram(buckets=buckets, worst=worst)
+
+
+# ======================================================================================
 @dataclass
 class Stats:
     count: int = 0
     hours: float = 0.0
+    queue_wait: Histogram = field(default_factory=Histogram)  # submitted -> started
+    runtime: Histogram = field(default_factory=Histogram)  # started -> updated
+
+    def merge(self, other: "Stats") -> None:
+        self.count += other.count
+        self.hours += other.hours
+        self.queue_wait.merge(other.queue_wait)
+        self.runtime.merge(other.runtime)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "hours": self.hours,
+            "queue_wait": self.queue_wait.to_json(),
+            "runtime": self.runtime.to_json(),
+        }
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> "Stats":
+        return Stats(
+            count=data["count"],
+            hours=data["hours"],
+            queue_wait=Histogram.from_json(data["queue_wait"]),
+            runtime=Histogram.from_json(data["runtime"]),
+        )
 
-stats_per_month_per_target: Dict[str, Dict[str, Stats]] = defaultdict(lambda: defaultdict(Stats))
 
-report_iterator = output_bucket.list_blobs(prefix="run-")
-for page in report_iterator.pages:
-    print("Processing page {}".format(report_iterator.page_number))
-    for report in page:
+StatsPerMonthPerGroup = Dict[str, Dict[str, Stats]]
+
+
+# ======================================================================================
+@dataclass
+class Rollup:
+    watermark: Optional[datetime]  # Reports created up to here are accounted for.
+    targets: StatsPerMonthPerGroup = field(default_factory=lambda: new_stats())
+    nodepools: StatsPerMonthPerGroup = field(default_factory=lambda: new_stats())
+
+    def add_report(self, report: Any) -> int:
         meta = report.metadata
         if not meta or "cp2kci-started" not in meta or "cp2kci-updated" not in meta:
-            continue  # without timestamps
+            return 0  # without timestamps
         target = report.name.rsplit("-", 1)[0][4:]
+        nodepools = meta.get("cp2kci-nodepools", "unknown")
         month = report.time_created.strftime("%Y-%m")
         started = datetime.fromisoformat(meta["cp2kci-started"])
         last_updated = datetime.fromisoformat(meta["cp2kci-updated"])
         duration = last_updated - started
-        if duration.total_seconds() > 0:
-            stats = stats_per_month_per_target[month][target]
+        if duration.total_seconds() <= 0:
+            return 0
+        for stats in self.targets[month][target], self.nodepools[month][nodepools]:
             stats.count += 1
             stats.hours += duration.total_seconds() / 3600
+            stats.runtime.add(duration.total_seconds(), report.name)
+            if "cp2kci-submitted" in meta:
+                submitted = datetime.fromisoformat(meta["cp2kci-submitted"])
+                queue_wait = (started - submitted).total_seconds()
+                stats.queue_wait.add(queue_wait, report.name)
+        return 1
+
+    def merge(self, other: "Rollup") -> None:
+        pairs = [(self.targets, other.targets), (self.nodepools, other.nodepools)]
+        for mine, theirs in pairs:
+            for month, stats_per_group in theirs.items():
+                for group, s in stats_per_group.items():
+                    mine[month][group].merge(s)
+
+
+# ======================================================================================
+def main() -> None:
+    upload = "--upload" in sys.argv
+    rebuild = "--rebuild" in sys.argv
+
+    rollup = Rollup(watermark=None)
+    if not rebuild:
+        rollup = load_rollup() or rollup
+    print(f"Starting from watermark: {rollup.watermark}")
+
+    # Reports within the settle window are only shown provisionally.
+    new_watermark = datetime.now(timezone.utc) - SETTLE_WINDOW
+    provisional = Rollup(watermark=None)
+    num_settled = num_provisional = 0
+    for report in list_reports():
+        if rollup.watermark and report.time_created <= rollup.watermark:
+            continue  # already accounted for
+        if report.time_created <= new_watermark:
+            num_settled += rollup.add_report(report)
+        else:
+            num_provisional += provisional.add_report(report)
+    rollup.watermark = new_watermark
+    print(f"Processed {num_settled} settled and {num_provisional} provisional reports.")
+
+    overall = Rollup(watermark=None)
+    overall.merge(rollup)
+    overall.merge(provisional)
+    usage_stats = format_usage_stats(overall.targets)
+    print("\n\n" + usage_stats)
+    analytics = format_analytics_json(overall)
+    analytics_csv = format_analytics_csv(overall)
+
+    # upload
+    if upload:
+        store_rollup(rollup)
+        usage_stats_blob = output_bucket.blob("usage_stats.txt")
+        usage_stats_blob.cache_control = "no-cache"
+        usage_stats_blob.upload_from_string(usage_stats)
+        print("Uploaded to: " + usage_stats_blob.public_url)
+        upload_output("usage_stats.json", analytics, "application/json")
+        upload_output("usage_stats.csv", analytics_csv, "text/csv")
+
+
+# ======================================================================================
+def new_stats() -> StatsPerMonthPerGroup:
+    return defaultdict(lambda: defaultdict(Stats))
+
+
+# ======================================================================================
+def load_rollup() -> Optional[Rollup]:
+    blob = output_bucket.blob(ROLLUP_PATH)
+    if not blob.exists():
+        return None
+    data = json.loads(blob.download_as_bytes())
+    if data.get("version") != ROLLUP_VERSION:
+        print("Found rollup of different version, rebuilding.")
+        return None
+    rollup = Rollup(watermark=datetime.fromisoformat(data["watermark"]))
+    pairs = [(rollup.targets, data["targets"]), (rollup.nodepools, data["nodepools"])]
+    for groups, groups_data in pairs:
+        for month, stats_per_group in groups_data.items():
+            for group, stats in stats_per_group.items():
+                groups[month][group] = Stats.from_json(stats)
+    return rollup
+
+
+# ======================================================================================
+def store_rollup(rollup: Rollup) -> None:
+    assert rollup.watermark
+    watermark = rollup.watermark.isoformat()
+    data = {
+        "version": ROLLUP_VERSION,
+        "watermark": watermark,
+        "targets": stats_to_json(rollup.targets, Stats.to_json),
+        "nodepools": stats_to_json(rollup.nodepools, Stats.to_json),
+    }
+    blob = output_bucket.blob(ROLLUP_PATH)
+    blob.cache_control = "no-cache"
+    blob.upload_from_string(json.dumps(data, indent=1), content_type="application/json")
+    print("Stored rollup with watermark: " + watermark)
+
+
+# ======================================================================================
+def list_reports() -> Iterator[Any]:
+    starts = ["run-"] + SHARD_BOUNDARIES
+    ends: List[Optional[str]] = [*SHARD_BOUNDARIES, None]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        shards = executor.map(list_shard, zip(starts, ends))
+        for shard in shards:
+            yield from shard
+
+
+# ======================================================================================
+def list_shard(shard: Tuple[str, Optional[str]]) -> List[Any]:
+    start_offset, end_offset = shard
+    report_iterator = output_bucket.list_blobs(
+        prefix="run-",
+        match_glob="run-*_report.txt",
+        start_offset=start_offset,
+        end_offset=end_offset,
+        fields=LISTING_FIELDS,
+    )
+    reports = list(report_iterator)
+    print(f"Listed {len(reports)} reports from shard {start_offset}.")
+    return reports
+
+
+# ======================================================================================
+def format_usage_stats(stats_per_month_per_target: StatsPerMonthPerGroup) -> str:
+    usage_lines = []
+    for month in sorted(stats_per_month_per_target, reverse=True):
+        usage_lines.append(f"########## CP2K-CI stats for {month} ##########\n")
+        stats_per_target = stats_per_month_per_target[month]
+        usage_lines.append("Target                          Count     Hours")
+        usage_lines.append("-----------------------------------------------")
+        for target, s in sorted(
+            stats_per_target.items(), key=lambda kv: kv[1].hours, reverse=True
+        ):
+            usage_lines.append(f"{target:30s} {s.count:6d} {s.hours:9.1f}")
+        usage_lines.append("-----------------------------------------------")
+        total_count = sum(s.count for s in stats_per_target.values())
+        total_hours = sum(s.hours for s in stats_per_target.values())
+        usage_lines.append(f"{'Sum':30s} {total_count:6d} {total_hours:9.1f}")
+        usage_lines.append("\n\n\n")
+
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    usage_lines.append("Last updated: " + now.isoformat())
+    usage_lines.append("")
+    return "\n".join(usage_lines)
+
+
+# ======================================================================================
+def stats_to_json(
+    stats_per_month_per_group: StatsPerMonthPerGroup,
+    convert: Callable[[Stats], Dict[str, Any]],
+) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    return {
+        month: {group: convert(s) for group, s in sorted(stats_per_group.items())}
+        for month, stats_per_group in sorted(stats_per_month_per_group.items())
+    }
+
+
+# ======================================================================================
+def summarize(stats: Stats) -> Dict[str, Any]:
+    summary: Dict[str, Any] = {"count": stats.count, "hours": round(stats.hours, 2)}
+    for name, histogram in ("queue_wait", stats.queue_wait), ("runtime", stats.runtime):
+        for p in PERCENTILES:
+            summary[f"{name}_p{p}_seconds"] = histogram.percentile(p)
+        summary[f"{name}_worst"] = [
+            {"seconds": round(seconds), "report": report}
+            for seconds, report in histogram.worst
+        ]
+    return summary
+
+
+# ======================================================================================
+def format_analytics_json(rollup: Rollup) -> str:
+    analytics = {
+        "targets": stats_to_json(rollup.targets, summarize),
+        "nodepools": stats_to_json(rollup.nodepools, summarize),
+    }
+    return json.dumps(analytics, indent=1)
+
+
+# ======================================================================================
+def format_analytics_csv(rollup: Rollup) -> str:
+    columns = ["month", "kind", "name", "count", "hours"]
+    for name in "queue_wait", "runtime":
+        columns += [f"{name}_p{p}_seconds" for p in PERCENTILES]
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    for kind, groups in ("target", rollup.targets), ("nodepool", rollup.nodepools):
+        for month, summaries in stats_to_json(groups, summarize).items():
+            for name, summary in summaries.items():
+                writer.writerow({"month": month, "kind": kind, "name": name, **summary})
+    return output.getvalue()
+
+
+# ======================================================================================
+def upload_output(path: str, content: str, content_type: str) -> None:
+    blob = output_bucket.blob(path)
+    blob.cache_control = "no-cache"
+    blob.upload_from_string(content, content_type=content_type)
+    print("Uploaded to: " + blob.public_url)
+
 
-usage_lines = []
-for month in sorted(stats_per_month_per_target, reverse=True):
-    usage_lines.append(f"########## CP2K-CI stats for {month} ##########\n")
-    stats_per_target = stats_per_month_per_target[month]
-    usage_lines.append("Target                          Count     Hours")
-    usage_lines.append("-----------------------------------------------")
-    for target, s in sorted(stats_per_target.items(), key=lambda kv: kv[1].hours, reverse=True):
-        usage_lines.append(f"{target:30s} {s.count:6d} {s.hours:9.1f}")
-    usage_lines.append("-----------------------------------------------")
-    total_count = sum(s.count for s in stats_per_target.values())
-    total_hours = sum(s.hours for s in stats_per_target.values())
-    usage_lines.append(f"{'Sum':30s} {total_count:6d} {total_hours:9.1f}")
-    usage_lines.append("\n\n\n")
-
-now = datetime.now(timezone.utc).replace(microsecond=0)
-usage_lines.append("Last updated: " + now.isoformat())
-usage_lines.append("")
-
-usage_stats = "\n".join(usage_lines)
-print("\n\n" + usage_stats)
-
-# upload
-if sys.argv[-1] == "--upload":
-    usage_stats_blob = output_bucket.blob("usage_stats.txt")
-    usage_stats_blob.cache_control = "no-cache"
-    usage_stats_blob.upload_from_string(usage_stats)
-    print("Uploaded to: " + usage_stats_blob.public_url)
+# ======================================================================================
+if __name__ == "__main__":
+    main()
 
 # EOF